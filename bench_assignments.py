@@ -0,0 +1,47 @@
+"""
+Benchmark of BayesClassifier._get_likely_category_assignments (the k-best
+search over column category assignments), on synthetic category lists.
+
+usage: python bench_assignments.py [repetitions]
+"""
+import random
+import sys
+import time
+
+from geowhiz.classifier import BayesClassifier
+
+COLUMNS = [1, 5, 20, 50, 100]
+CANDIDATES = [10, 100, 300]
+TOP = 20
+
+
+def synthetic_category_lists(columns, candidates, rnd):
+    category_lists = []
+    for i in range(columns):
+        weights = sorted((rnd.paretovariate(1.5) for j in range(candidates)),
+                         reverse=True)
+        total = sum(weights)
+        category_lists.append([{'normalized_prob': w / total}
+                               for w in weights])
+    return category_lists
+
+
+if __name__ == '__main__':
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    classifier = BayesClassifier(None, None)
+    rnd = random.Random(0)
+
+    print '%8s %11s %12s %8s' % ('columns', 'candidates', 'ms/search',
+                                 'results')
+    for columns in COLUMNS:
+        for candidates in CANDIDATES:
+            category_lists = synthetic_category_lists(columns, candidates,
+                                                      rnd)
+            start = time.time()
+            for i in range(repetitions):
+                results = classifier._get_likely_category_assignments(
+                    category_lists, top=TOP)
+            elapsed = (time.time() - start) / repetitions
+            assert len(set(tuple(r[0]) for r in results)) == len(results)
+            print '%8d %11d %12.3f %8d' % (columns, candidates,
+                                           elapsed * 1000, len(results))
@@ -1,2 +1,2 @@
-from .geowhiz import GeoWhiz
+from .geowhiz import GeoWhiz, TAXONOMY_VERSION
 from .gazetteer import Gazetteer
@@ -0,0 +1,259 @@
+"""
+Bulk geotagging of the lists or tables in a CSV (or TSV) file, using a pool of
+worker processes.
+
+Tables are separated by blank lines or, with --id-column, made of consecutive
+rows that share a value in that column.  Each (other) column of a table is a
+column of the geotagged grid.  Results are written as newline-delimited JSON,
+one line per table, in input order:
+
+    {"id": <table id>, "results": <geotag_full results>}
+
+or {"id": <table id>, "error": <message>} if the table could not be read or
+geotagged.  A table cannot be read if one of its rows is not valid UTF-8 or
+(with --id-column) is too short to have an id; rows without an id make up
+tables of their own, with a null id.  Tables are numbered from 0 when there is
+no id column.
+
+usage: python -m geowhiz.bulk [options] input.csv > output.ndjson
+"""
+from __future__ import absolute_import
+
+import argparse
+import collections
+import csv
+import itertools
+import json
+import multiprocessing
+import signal
+import sys
+
+import geowhiz
+
+
+def open_gazetteer(filename):
+    if filename.endswith('.snapshot'):
+        from geowhiz.gaz.snapshot import snapshotGaz
+        return snapshotGaz(filename)
+    from geowhiz.gaz.sqlite import sqliteGaz
+    return sqliteGaz(filename)
+
+
+def read_rows(f, delimiter=',', id_column=None):
+    """Yields (id, cells) for each row of a CSV file, with the cells decoded
+    and stripped, and without the id column.  cells is a ValueError for rows
+    that cannot be read."""
+    reader = csv.reader(f, delimiter=delimiter)
+    for row in reader:
+        table_id = None
+        if not any(row):
+            yield table_id, []
+            continue
+        try:
+            if id_column is not None:
+                if len(row) <= id_column:
+                    raise ValueError('line %d has no column %d' %
+                                     (reader.line_num, id_column))
+                table_id = row[id_column].decode('utf8').strip()
+                row = row[:id_column] + row[id_column + 1:]
+            cells = [c.decode('utf8').strip() for c in row]
+        except UnicodeDecodeError as e:
+            cells = ValueError('line %d is not valid UTF-8 (%s)' %
+                               (reader.line_num, e))
+        except ValueError as e:
+            cells = e
+        yield table_id, cells
+
+
+def nonblank(row):
+    table_id, cells = row
+    return isinstance(cells, ValueError) or bool(table_id) or any(cells)
+
+
+def read_tables(f, delimiter=',', id_column=None):
+    """Yields (id, rows) for each table in a CSV file.  rows is a ValueError
+    (for its first bad row) if the table cannot be read."""
+    rows = read_rows(f, delimiter, id_column)
+    if id_column is None:
+        tables = enumerate(g for is_nonblank, g in
+                           itertools.groupby(rows, nonblank) if is_nonblank)
+    else:
+        tables = itertools.groupby(itertools.ifilter(nonblank, rows),
+                                   lambda row: row[0])
+    for table_id, g in tables:
+        table = [cells for _, cells in g]
+        errors = [e for e in table if isinstance(e, ValueError)]
+        yield table_id, errors[0] if errors else table
+
+
+def to_grid(rows):
+    return [list(col) for col in itertools.izip_longest(*rows, fillvalue=u'')]
+
+
+def result_line(table_id, results):
+    return '{"id": %s, "results": %s}' % (json.dumps(table_id),
+                                          results.toJSON())
+
+
+def error_line(table_id, e):
+    return json.dumps({'id': table_id, 'error': '%s: %s' % (
+        type(e).__name__, e)})
+
+
+# GeoWhiz instance and geotag_full options of the current (worker) process
+_geowhiz = None
+_options = None
+
+
+def load_geowhiz(gaz_filename, model_file, options):
+    global _geowhiz, _options
+    _geowhiz = geowhiz.GeoWhiz(open_gazetteer(gaz_filename),
+                               model_file=model_file)
+    _options = options
+
+
+def init_worker(gaz_filename, model_file, options):
+    # interrupts are handled by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_geowhiz(gaz_filename, model_file, options)
+
+
+def geotag_batch(batch):
+    """Geotags a list of (id, rows) tables, sharing one gazetteer lookup.
+    Returns the output line for each table."""
+    lines = [error_line(table_id, rows) if isinstance(rows, Exception)
+             else None for table_id, rows in batch]
+    tables = [(i, table_id, to_grid(rows))
+              for i, (table_id, rows) in enumerate(batch)
+              if lines[i] is None]
+    done = 0
+    try:
+        results = _geowhiz.geotag_many([grid for _, _, grid in tables],
+                                       batch_size=len(tables), **_options)
+        for (i, table_id, grid), r in itertools.izip(tables, results):
+            lines[i] = result_line(table_id, r)
+            done += 1
+    except Exception:
+        # geotag the remaining tables one at a time, to isolate failures
+        for i, table_id, grid in tables[done:]:
+            try:
+                lines[i] = result_line(
+                    table_id, _geowhiz.geotag_full(grid, **_options))
+            except Exception as e:
+                lines[i] = error_line(table_id, e)
+    return lines
+
+
+def ordered_imap(pool, func, iterable, max_pending):
+    """Like pool.imap, but reads at most max_pending items of iterable ahead
+    of the results that have been consumed"""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def prepare_model(gaz_filename, model_file):
+    # trains and saves the model if it is missing or stale
+    geowhiz.GeoWhiz(open_gazetteer(gaz_filename), model_file=model_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m geowhiz.bulk',
+        description='Geotag the lists or tables in a CSV or TSV file, '
+                    'writing newline-delimited JSON results.')
+    parser.add_argument('input', help="CSV or TSV file ('-' for stdin)")
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    parser.add_argument('--gaz', default='./gaz.db',
+                        help='gazetteer database, or .snapshot file '
+                             '(default: %(default)s)')
+    parser.add_argument('--model',
+                        help='saved classifier model, created or updated if '
+                             'stale (default: train in each worker)')
+    parser.add_argument('--delimiter',
+                        help='field delimiter (default: tab for .tsv files, '
+                             'comma otherwise)')
+    parser.add_argument('--id-column', type=int,
+                        help='index of a column identifying the table of '
+                             'each row (default: tables are separated by '
+                             'blank lines)')
+    parser.add_argument('-j', '--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: '
+                             '%(default)s)')
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help='tables sent to a worker at a time '
+                             '(default: %(default)s)')
+    parser.add_argument('--resolution-method', default='both',
+                        choices=['prominence', 'proximity', 'both'])
+    parser.add_argument('--max-resolved', type=int, default=1,
+                        help='number of assignments per table with '
+                             'interpretations (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of assignments per table '
+                             '(default: %(default)s)')
+    parser.add_argument('--include-text', action='store_true',
+                        help='include text descriptions of categories')
+    parser.add_argument('--sample-size', type=int,
+                        help='choose column categories from a random sample '
+                             'of at least this many cells (default: all '
+                             'cells)')
+    parser.add_argument('--sample-tolerance', type=float, default=0.01,
+                        help='stability required of sampled results '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    options = {'resolution_method': args.resolution_method,
+               'include_text': args.include_text,
+               'max_resolved': args.max_resolved,
+               'top': args.top,
+               'sample_size': args.sample_size,
+               'sample_tolerance': args.sample_tolerance}
+    delimiter = args.delimiter or ('\t' if args.input.endswith('.tsv')
+                                   else ',')
+
+    f = sys.stdin if args.input == '-' else open(args.input, 'rb')
+    out = open(args.output, 'w') if args.output else sys.stdout
+
+    tables = read_tables(f, delimiter, args.id_column)
+    batches = iter(lambda: list(itertools.islice(tables, args.batch_size)),
+                   [])
+
+    pool = None
+    if args.workers > 1:
+        if args.model:
+            # make sure the model is current before the workers load it (in a
+            # separate process, so no database connections are forked)
+            p = multiprocessing.Process(target=prepare_model,
+                                        args=(args.gaz, args.model))
+            p.start()
+            p.join()
+        pool = multiprocessing.Pool(args.workers, init_worker,
+                                    (args.gaz, args.model, options))
+        results = ordered_imap(pool, geotag_batch, batches, args.workers * 2)
+    else:
+        load_geowhiz(args.gaz, args.model, options)
+        results = itertools.imap(geotag_batch, batches)
+
+    try:
+        for lines in results:
+            for line in lines:
+                out.write(line)
+                out.write('\n')
+            out.flush()
+    except KeyboardInterrupt:
+        if pool is not None:
+            pool.terminate()
+        sys.exit(130)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,10 @@
 Helper functions for dealing with categories that may have different
 representations.
 """
+import itertools
+import json
+import threading
+import zlib
 
 
 def s_to_l(strings):
@@ -36,3 +40,158 @@ def satisfies_s(strings1, strings2):
     # match (i.e., _|P|PPL|PPLA2 does not satisfy _|P|PPL|PPLA)
     return all((s1 + '|').startswith(s2 + '|')
                for (s1, s2) in zip(strings1, strings2))
+
+
+def cartesian_product(lists):
+    """
+    Returns the set of categories (tuples of strings) satisfied by a category
+    in list form, i.e. every combination of prefixes of each dimension.
+    """
+    return set(itertools.product(*s_to_all_s(l_to_s(lists))))
+
+
+def histogram(category_lists):
+    """
+    Maps each category satisfied by any of the given categories (in list
+    form) to the number of them that satisfy it.
+    """
+    h = {}
+    for lists in category_lists:
+        for cat in cartesian_product(lists):
+            h[cat] = h.get(cat, 0) + 1
+    return h
+
+
+def encode_histogram(h):
+    """
+    Compact serialized form of a histogram: the distinct nodes of each
+    dimension, followed by (node index, ..., count) rows.
+    """
+    if not h:
+        return zlib.compress(json.dumps([[], []]))
+    dims = len(next(iter(h)))
+    nodes = [sorted(set(cat[i] for cat in h)) for i in range(dims)]
+    idx = [dict((n, j) for j, n in enumerate(d)) for d in nodes]
+    rows = [[idx[i][n] for i, n in enumerate(cat)] + [cnt]
+            for cat, cnt in h.iteritems()]
+    return zlib.compress(json.dumps([nodes, rows], separators=(',', ':')))
+
+
+def decode_histogram(blob):
+    """
+    Decodes a histogram written by encode_histogram, keyed by LATTICE node
+    ids.
+    """
+    nodes, rows = json.loads(zlib.decompress(blob))
+    ids = [[LATTICE.node(n) for n in d] for d in nodes]
+    return dict((tuple(d[i] for d, i in zip(ids, r[:-1])), r[-1])
+                for r in rows)
+
+
+class Lattice(object):
+    """
+    Interns category nodes (e.g., 'dim1|NA|US|VA') as integer ids.
+
+    Within the classifier, a category is a tuple with one node id per
+    dimension.  For each node, the lattice keeps its parent, its depth and
+    its path (the ids of all its ancestors, root first, including itself),
+    so that prefix tests and expansions do not need any string operations.
+    String forms are only needed for output.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+        self.parents = []
+        self.depths = []
+        self.paths = []
+        self.ancestors = []
+        self._lock = threading.RLock()
+
+    def node(self, s):
+        nid = self.ids.get(s)
+        if nid is not None:
+            return nid
+        with self._lock:
+            if s in self.ids:
+                return self.ids[s]
+            i = s.rfind('|')
+            parent = self.node(s[:i]) if i >= 0 else None
+            nid = len(self.strings)
+            self.strings.append(s)
+            self.parents.append(parent)
+            self.depths.append(s.count('|'))
+            path = (self.paths[parent] if parent is not None else ()) + (nid,)
+            self.paths.append(path)
+            self.ancestors.append(frozenset(path))
+            # publish the id only once the node is complete
+            self.ids[s] = nid
+            return nid
+
+    def from_s(self, strings):
+        """
+        ('dim0|P', 'dim1|NA') => (id of 'dim0|P', id of 'dim1|NA')
+        """
+        return tuple(self.node(s) for s in strings)
+
+    def from_l(self, lists):
+        return self.from_s(l_to_s(lists))
+
+    def to_s(self, cat):
+        return [self.strings[n] for n in cat]
+
+    def depth(self, cat):
+        """Combined depth of all dimensions of a category"""
+        return sum(self.depths[n] for n in cat)
+
+    def satisfies(self, cat1, cat2):
+        """
+        Returns true iff cat1 satisfies cat2 (i.e., each node of cat2 is an
+        ancestor of, or equal to, the respective node of cat1)
+        """
+        ancestors = self.ancestors
+        return all(n2 in ancestors[n1] for n1, n2 in zip(cat1, cat2))
+
+    def cartesian_product(self, cat):
+        """
+        Returns all categories satisfied by cat.  Since node paths are
+        distinct, no duplicates are generated.
+        """
+        return itertools.product(*[self.paths[n] for n in cat])
+
+
+class SatisfyingSet(object):
+    """
+    A set of categories (of a Lattice), supporting tests of whether some
+    member satisfies a given category, without expanding the members into
+    all the categories they satisfy.
+
+    For each dimension, every node maps to a bitmask of the members whose
+    node in that dimension is the same node or one of its descendants.
+    """
+    def __init__(self, lattice):
+        self.paths = lattice.paths
+        self.masks = None
+        self.size = 0
+
+    def add(self, cat):
+        if self.masks is None:
+            self.masks = [{} for n in cat]
+        bit = 1 << self.size
+        self.size += 1
+        for masks, n in zip(self.masks, cat):
+            for a in self.paths[n]:
+                masks[a] = masks.get(a, 0) | bit
+
+    def satisfies(self, cat):
+        """Returns true iff some member satisfies cat"""
+        if self.masks is None:
+            return False
+        mask = -1
+        for masks, n in zip(self.masks, cat):
+            mask &= masks.get(n, 0)
+            if not mask:
+                return False
+        return True
+
+
+LATTICE = Lattice()
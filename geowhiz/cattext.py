@@ -1,16 +1,14 @@
 # coding=utf-8
+import collections
 import locale
+import threading
 locale.setlocale(locale.LC_ALL, 'en_US.utf8')
 
+from lru import LRUCache
+
 TYPE_ROOT = 'dim0'
 GEO_ROOT = 'dim1'
 PROM_ROOT = 'dim2'
-GEONAME_CONTAINERS = {'_|NA|US': 'USA'}
-STATIC = {'_|NA|US': 'the United States'}
-fmt = lambda x: 'in %s' % (
-    STATIC.get(x, GEONAME_CONTAINERS.get(x, 'UNKNOWN')),
-)
-SIMPLE_CONTAINERS = {}
 
 CONTINENTS = {
     'NA': 'North America',
@@ -23,11 +21,78 @@ CONTINENTS = {
 }
 
 
+class ContainerNames(object):
+    """Names of the countries and admin regions that geo categories refer
+    to, keyed by tuples of their codes (e.g. ('US', 'VA'), see
+    Gazetteer.get_container_names).
+
+    The containers of preload_levels (by default countries, admin1 and admin2
+    regions) are all loaded, with one query per level, when first needed.
+    Others are fetched with one query per level for each call to names, and
+    kept in a bounded cache.  Thread-safe."""
+
+    def __init__(self, gaz, max_entries=100000, preload_levels=(1, 2, 3)):
+        self.gaz = gaz
+        self.preload_levels = preload_levels
+        self.cache = LRUCache(max_entries)
+        self._preloaded = None
+        self._lock = threading.Lock()
+
+    def _preload(self):
+        with self._lock:
+            if self._preloaded is None:
+                preloaded = {}
+                for level in self.preload_levels:
+                    # (nothing is returned by gazetteers that cannot list
+                    # their containers)
+                    names = self.gaz.get_container_names(level)
+                    if names:
+                        preloaded[level] = dict(
+                            ('|'.join(k), v) for k, v in names.iteritems())
+                self._preloaded = preloaded
+            return self._preloaded
+
+    def names(self, keys):
+        """Returns the name of each container in keys ('' if it has none)"""
+        preloaded = self._preload()
+        names = {}
+        missing = collections.defaultdict(list)
+        for k in set(keys):
+            if len(k) in preloaded:
+                names[k] = preloaded[len(k)].get('|'.join(k), '')
+                continue
+            name = self.cache.get(k)
+            if name is None:
+                missing[len(k)].append(k)
+            else:
+                names[k] = name
+        for level, level_keys in missing.iteritems():
+            found = self.gaz.get_container_names(level, level_keys)
+            for k in level_keys:
+                names[k] = found.get(k, '')
+                self.cache.put(k, names[k])
+        return names
+
+    def name(self, key):
+        return self.names([key])[key]
+
+    def cache_stats(self):
+        """Hit/miss/eviction counts of the cache, and the number of preloaded
+        names"""
+        stats = self.cache.stats()
+        stats['preloaded'] = sum(len(names) for names in
+                                 (self._preloaded or {}).itervalues())
+        return stats
+
+
 class CatText(object):
 
-    def __init__(self, gaz):
-        self.geoname_types = {}
+    def __init__(self, gaz, containers=None):
         self.gaz = gaz
+        self.containers = containers or ContainerNames(gaz)
+        # stored with the gazetteer by update_gaz.py (built here for older
+        # gazetteers)
+        self.geoname_types = gaz.get_type_text() or load_geoname_types(gaz)
 
     def lookup_type_code(self, type_code, plural=True):
         """
@@ -41,10 +106,6 @@ class CatText(object):
             t = {'type': 'administrative region',
                  'plural': 'administrative regions'}
         else:
-            if len(self.geoname_types) == 0:
-                print 'LOADING GEONAME TYPE STRINGS'
-                self.geoname_types = load_geoname_types(self.gaz)
-
             t = self.geoname_types.get(type_code, default)
 
         if plural:
@@ -64,73 +125,43 @@ class CatText(object):
         )
         return u'with population ≥ %s' % (val,)
 
+    def prefetch(self, geo_strings, max_depth=7):
+        """Fetches the container names needed for the text of many geo
+        categories (and their ancestors, down to max_depth parts) at once"""
+        keys = set()
+        for geo_s in geo_strings:
+            codes = geo_s.split('|')[2:max_depth]
+            keys.update(tuple(codes[:i+1]) for i in range(len(codes)))
+        self.containers.names(keys)
+
     def geo_text(self, geo_s, max_depth=5):
         if geo_s == GEO_ROOT:
             return 'around the world'
 
         geo_l = geo_s.split('|')
 
-        k = '|'.join(geo_l[:max_depth])
-
-        if k in GEONAME_CONTAINERS:
-            return fmt(k)
-
         # return continent name
-        if geo_s.count('|') == 1:
-            continent_code = geo_s[geo_s.index('|') + 1:]
-            GEONAME_CONTAINERS[k] = CONTINENTS[continent_code]
-            return fmt(k)
-
-        last_vals = None
-        for i, f in enumerate([self.gaz.get_container_country,
-                               self.gaz.get_container_admin1,
-                               self.gaz.get_container_admin2]):
-            if len(geo_l) < i + 2:
-                break
-            k = '|'.join(geo_l[:i+3])
-            if k not in GEONAME_CONTAINERS:
-                res = f(geo_l[2:i+3])
-                if res and res[0] and last_vals:
-                    GEONAME_CONTAINERS[k] = res[0] + ', ' + last_vals
-                elif last_vals:
-                    GEONAME_CONTAINERS[k] = last_vals
-                elif res and res[0]:
-                    GEONAME_CONTAINERS[k] = res[0]
-                else:
-                    GEONAME_CONTAINERS[k] = ''
-            last_vals = GEONAME_CONTAINERS[k]
-
-        return fmt(k)
+        if len(geo_l) == 2:
+            return 'in %s' % (CONTINENTS[geo_l[1]],)
 
-    def simple_geo_text(self, geo_s):
-        if geo_s in SIMPLE_CONTAINERS:
-            return SIMPLE_CONTAINERS[geo_s]
+        # e.g. 'in Fairfax, Virginia, United States' (containers without
+        # names are skipped)
+        codes = geo_l[2:max_depth]
+        keys = [tuple(codes[:i+1]) for i in range(len(codes))]
+        names = self.containers.names(keys)
+        return 'in %s' % (', '.join(names[k] for k in reversed(keys)
+                                    if names[k]),)
 
+    def simple_geo_text(self, geo_s):
         geo_l = geo_s.split('|')
 
-        res = ''
-
         if len(geo_l) == 1:
             return 'Earth'
         elif len(geo_l) == 2:
             return CONTINENTS[geo_l[-1]]
-        elif len(geo_l) == 3:
-            res = self.gaz.get_container_country(geo_l[2:3])
-        elif len(geo_l) == 4:
-            res = self.gaz.get_container_admin1(geo_l[2:4])
-        elif len(geo_l) == 5:
-            res = self.gaz.get_container_admin2(geo_l[2:5])
-        elif len(geo_l) == 6:
-            res = self.gaz.get_container_admin3(geo_l[2:6])
-        elif len(geo_l) == 7:
-            res = self.gaz.get_container_admin4(geo_l[2:7])
-
-        if res and res[0]:
-            SIMPLE_CONTAINERS[geo_s] = res[0]
-            return res[0]
-        else:
-            return ''
-
+        elif len(geo_l) <= 7:
+            return self.containers.name(tuple(geo_l[2:]))
+        return ''
 
     def cat_text(self, cat_s, cnt=2):
         type_txt = prom_txt = geo_txt = None
@@ -168,6 +199,13 @@ class CatText(object):
 
 
 def load_geoname_types(gaz):
+    return build_type_text(gaz.get_types())
+
+
+def build_type_text(featurecodes):
+    """Returns the text ({'type', 'plural', 'desc'}) of each type category
+    string, given the (fclass, fcode, name, description) rows of the
+    featurecodes table"""
     types = [
         {'t1': 'A', 't2': None, 't3': None, 'desc': '',
          'type': 'Administrative region',
@@ -196,8 +234,7 @@ def load_geoname_types(gaz):
          'type': 'forest or area of vegetation',
          'plural': 'forests or areas of vegetation'},
     ]
-    geoname_types_raw = list(gaz.get_types())
-    for fclass, fcode, name, description in geoname_types_raw:
+    for fclass, fcode, name, description in featurecodes:
         if not fclass or not name:
             continue
         types.append({'t1': fclass,
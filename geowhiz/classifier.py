@@ -1,28 +1,101 @@
+import functools
 import heapq
 import itertools
+import json
 import math
 import operator
+import os
+import random
 import sys
 
 import category
+import proximity
+from category import LATTICE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 product = lambda x: reduce(operator.mul, x, 1)
-geom_mean = lambda x: math.pow(math.e, sum(math.log(v) for v in x) / len(x))
-depth = lambda x: x.count('|')
+log = lambda x: math.log(x) if x > 0 else float('-inf')
+
+
+# number of top categories (by coverage, depth and ambiguity) considered as
+# candidates for each column
+MAX_COLUMN_CANDIDATES = 300
+
+# default tolerance for the change in the margin between the top two
+# categories of a sampled column (see ColumnClassifier._classify_sampled_column)
+SAMPLE_TOLERANCE = 0.01
+
+
+def unique_values(column):
+    """Returns the distinct values of a column, in order of first occurrence,
+    with the number of times each occurs"""
+    counts = {}
+    values = []
+    for v in column:
+        if v in counts:
+            counts[v] += 1
+        else:
+            counts[v] = 1
+            values.append(v)
+    return [(v, counts[v]) for v in values]
+
+
+# category counts sum the logs of interpretation counts in fixed point, as
+# integers, so that sums are exact and do not depend on the order in which
+# cells are added (or removed, see GridSession)
+LOG_SCALE = 2 ** 32
+
+
+def log_count(cnt):
+    """Log of a count of interpretations, scaled by LOG_SCALE"""
+    if cnt < len(LOG_COUNTS):
+        return LOG_COUNTS[cnt]
+    return int(round(math.log(cnt) * LOG_SCALE))
+
+LOG_COUNTS = [None] + [int(round(math.log(cnt) * LOG_SCALE))
+                       for cnt in xrange(1, 1024)]
+
+
+# ambiguity is rounded to this many significant digits, far coarser than the
+# error of the fixed-point sums, so that it comes out as it would from a
+# floating-point geometric mean (e.g. exactly 2.0 for cells with 2
+# interpretations each) wherever it is reported or featurized
+AMBIGUITY_DIGITS = 9
+
+
+def ambiguity(coverage, log_sum):
+    """Geometric mean of the interpretation counts of the covered cells,
+    given the sum of their log_count values"""
+    amb = math.exp(float(log_sum) / (coverage * LOG_SCALE))
+    return float('%.*g' % (AMBIGUITY_DIGITS, amb))
 
 
 def filter_column_results(results):
-    seen = set()
+    """Drops results whose category is satisfied by the category of an
+    earlier result (i.e., is a generalization of it)"""
+    seen = category.SatisfyingSet(LATTICE)
     filtered_results = []
 
     for res in results:
-        if tuple(res['category']) in seen:
+        if seen.satisfies(res['category']):
             continue
-        seen.update(itertools.product(*category.s_to_all_s(res['category'])))
+        seen.add(res['category'])
         filtered_results.append(res)
     return filtered_results
 
 
+def export_category_result(res):
+    """Copy of a candidate category result, with the category in string form
+    (as exposed in geotagging results)"""
+    res = dict(res)
+    res['category'] = LATTICE.to_s(res['category'])
+    return res
+
+
 class Categorizer(object):
     """Geotags a grid of strings.
 
@@ -35,7 +108,6 @@ class Categorizer(object):
         self.grid = grid
         self.geonames = geonames
         self.taxonomy = taxonomy
-        self._cache_prob = {}
 
     def get_top_categories(self):
         """Given grid of strings, finds possible categories for each column"""
@@ -49,6 +121,12 @@ class Categorizer(object):
 
         Return value is a list of tuples (category, covered_values_cnt, total)
         """
+        return self.get_top_value_categories(unique_values(column),
+                                             len(column))
+
+    def get_top_value_categories(self, values, total):
+        """Computes top candidate categories for a column given as (value,
+        number of occurrences) pairs, covering total cells"""
         # compute list of categories that are satisfied by some number of
         # cell values, along with the number of cells they cover
 
@@ -56,177 +134,105 @@ class Categorizer(object):
         # in row that are contained in those regions, as possible addition to
         # category predicate
 
-        # counts dict keeps track of number of interpretations that fall into
-        # each category.
+        # counts dict keeps track of the number of cells with interpretations
+        # that fall into each category, and the sum of the logs of the number
+        # of such interpretations of each cell (see log_count).  repeated
+        # cell values are only counted once, weighted by their number of
+        # occurrences.
         # Example: if cat1 is satisfied by 4 interpretations of cell1, 0
         # interpretations of cell2, and 2 interpretations of cell3, then
-        # counts[cat1] = [4, 2].
-        counts = self._count_categories(column)
-
-        # Add ambiguity and coverage statistics
-        # The example above would result in a coverage value of 2, total of 3,
-        # and ambiguity of (4*1*2) ^ (1/3) = 2.0
-        results = self._add_amb_and_cov(counts, column)
+        # counts[cat1] = [2, log(4) + log(2)].
+        counts = self._count_categories(values)
 
         # TODO: Add ambiguity resolution method
 
-        # default sort order for categories:
-        # - first sort by coverage ratio
-        # - next by the combined depth of the category over all dimensions
-        # - then by ambiguity value descending
-        return self._sort_and_filter_top_categories(results)
+        return self._top_categories(counts, total)
 
-    def _count_categories(self, column):
+    def _count_categories(self, values):
         counts = {}
-        for cell in column:
-            cell_counts = {}
-
-            # get list of interpretations for current toponym (cell value)
-            interpretations = self.geonames.get_by_name(cell)
-
-            for interpretation in interpretations:
-                cell_cats = self._category_cartesian_product(interpretation)
-                for category_s in cell_cats:
-                    if category_s not in cell_counts:
-                        cell_counts[category_s] = 0
-                    cell_counts[category_s] += 1
+        # (log_count, inlined)
+        log_counts = LOG_COUNTS
+        max_count = len(LOG_COUNTS)
+        for cell, weight in values:
+            # number of interpretations of current toponym (cell value) that
+            # fall into each category
+            cell_counts = self._cell_histogram(cell)
 
             # aggregate cell_counts values, for use in computing ambiguity and
             # coverage
             for cat, cnt in cell_counts.iteritems():
-                if cat not in counts:
-                    counts[cat] = []
-                counts[cat].append(cnt)
+                lc = log_counts[cnt] if cnt < max_count else log_count(cnt)
+                c = counts.get(cat)
+                if c is None:
+                    counts[cat] = [weight, weight * lc]
+                else:
+                    c[0] += weight
+                    c[1] += weight * lc
         return counts
 
-    def _category_cartesian_product(self, interpretation):
-        category_l = self.taxonomy.categorize(interpretation)
-        category_ss = category.l_to_all_s(category_l)
-        cell_cats = list(set(itertools.product(*category_ss)))
-        return cell_cats
-
-    def _add_amb_and_cov(self, counts, column):
-        results = []
-        for cat, cnts in counts.iteritems():
-            amb = geom_mean(cnts)
-            results.append({
-                'category': cat,
-                'stats': {'ambiguity': amb,
-                          'coverage': len(cnts),
-                          'total': len(column)}
-            })
-        return results
+    def _cell_histogram(self, cell):
+        # use histogram precomputed by the gazetteer (or by an earlier cell
+        # with the same value) if available
+        histogram = self.geonames.get_histogram(cell)
+        if histogram is None:
+            histogram = {}
+            for interpretation in self.geonames.get_by_name(cell):
+                cell_cat = self.geonames.get_category(interpretation)
+                for cat in LATTICE.cartesian_product(cell_cat):
+                    histogram[cat] = histogram.get(cat, 0) + 1
+            self.geonames.set_histogram(cell, histogram)
+        return histogram
+
+    def _top_categories(self, counts, total):
+        # Add ambiguity and coverage statistics
+        # The example above would result in a coverage value of 2, total of 3,
+        # and ambiguity (geometric mean) of (4*2) ^ (1/2) = 2.83
 
-    def _sort_and_filter_top_categories(self, results):
-        cats_sort_key = lambda x: (x['stats']['coverage'],
-                                   sum(depth(p) for p in x['category']),
-                                   -x['stats']['ambiguity'])
-        results = sorted(results, key=cats_sort_key, reverse=True)
-        top_results = results[:300]
+        # default sort order for categories:
+        # - first sort by coverage ratio
+        # - next by the combined depth of the category over all dimensions
+        # - then by ambiguity value descending
+        # only the top MAX_COLUMN_CANDIDATES are kept, in a bounded min-heap
+        # of (coverage, depth, -ambiguity, category strings) entries.  (ties
+        # are broken by the category strings rather than by node ids or dict
+        # order, which depend on the order in which the process first saw
+        # each category.)  ambiguity is only computed for categories whose
+        # coverage and depth could place them in the heap.
+        heap = []
+        depth = LATTICE.depth
+        to_s = LATTICE.to_s
+        for cat, (cov, log_sum) in counts.iteritems():
+            d = depth(cat)
+            if len(heap) == MAX_COLUMN_CANDIDATES:
+                if (cov, d) < heap[0][:2]:
+                    continue
+                entry = (cov, d, -ambiguity(cov, log_sum), to_s(cat), cat)
+                if entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+            else:
+                heapq.heappush(heap, (cov, d, -ambiguity(cov, log_sum),
+                                      to_s(cat), cat))
+        heap.sort(reverse=True)
 
-        return filter_column_results(top_results)
+        results = [{'category': cat,
+                    'stats': {'ambiguity': -neg_amb,
+                              'coverage': cov,
+                              'total': total}}
+                   for cov, d, neg_amb, _, cat in heap]
+        return filter_column_results(results)
 
 
 resolution_sort = lambda x: (x['population'], x['altnames'],
                              x['fcode'] == 'MT' and x['elevation'])
 
-def add_proximity_resolution(interpretations):
-    toRadians = lambda x: x * math.pi / 180
-    radius = 6371  # km
-
-    cache_pt = {}
-    cache_dist = {}
-    def geo_dist(pt1, pt2):
-        if (pt1, pt2) in cache_dist:
-            return cache_dist[(pt1, pt2)]
-        if pt1 in cache_pt:
-            lat1, lng1, lat1cos = cache_pt[pt1]
-        else:
-            lat1 = toRadians(pt1[0])
-            lng1 = toRadians(pt1[1])
-            lat1cos = math.cos(lat1)
-            cache_pt[pt1] = (lat1, lng1, lat1cos)
-        lat2 = toRadians(pt2[0])
-        lng2 = toRadians(pt2[1])
-        lat2cos = math.cos(lat2)
-
-        dlat = lat2 - lat1
-        dlng = lng2 - lng1
-
-        a = math.sin(dlat/2) ** 2 + math.sin(dlng/2) ** 2 * lat1cos * lat2cos
-        res = radius * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        cache_dist[(pt1, pt2)] = res
-        return res
-
-    cache_coord = {}
-    def geo_coord(lat, lng):
-        if (lat, lng) in cache_coord:
-            return cache_coord[(lat, lng)]
-        phi = (90 - lat) * math.pi / 180
-        theta = (lng) * math.pi / 180
-        x = math.sin(phi) * math.cos(theta)
-        y = math.sin(phi) * math.sin(theta)
-        z = math.cos(phi)
-        cache_coord[(lat, lng)] = (x, y, z)
-        return x, y, z
-
-    def geo_centroid(lat_lng_list):
-        xs = []
-        ys = []
-        zs = []
-        for lat, lng in lat_lng_list:
-            x, y, z = geo_coord(lat, lng)
-            xs.append(x)
-            ys.append(y)
-            zs.append(z)
-        x_c = sum(xs)
-        y_c = sum(ys)
-        z_c = sum(zs)
-        l = len(xs)
-        r = math.sqrt(x_c**2 + y_c**2 + z_c**2) / l
-        phi_c = math.acos(z_c / (l * r))
-        theta_c = math.atan2(y_c, x_c)
-        lat_c = 90 - 180 * (phi_c / math.pi)
-        lng_c = 180 * theta_c / math.pi
-        return (lat_c, lng_c)
-
-    def geo_mean_sq_dist(interp_list):
-        coord_list = [(i['latitude'], i['longitude']) for i in interp_list]
-
-        c = geo_centroid(coord_list)
-        sq_dists = [geo_dist(c, pt) ** 2 for pt in coord_list]
-        return (sum(sq_dists) / len(sq_dists))
-
+def add_proximity_resolution(interpretations, weights=None):
     # add two most prominent interpretations of each toponym as "seeds" for
-    # proximity testing
-    seeds = []
-    for wi in interpretations:
-        seeds.extend(wi[:2])
-
-    # iterate through all seeds, adding closest interpretation of each other
-    # toponym.  for each collection of interpretations, measure distance of
-    # each to the centroid of the collection.  collection that minimizes the
-    # sum of square distances "wins" and the respective interpretations are
-    # selected by the "proximity" method
-    best = []
-    best_dist = float('inf')
-    for s in seeds:
-        interp_set = []
-        for interp_list in interpretations:
-            best_interp = None
-            best_interp_dist = float('inf')
-            for i in interp_list:
-                i_dist = geo_dist((s['latitude'], s['longitude']),
-                                  (i['latitude'], i['longitude']))
-                if i_dist < best_interp_dist:
-                    best_interp = i
-                    best_interp_dist = i_dist
-            if best_interp:
-                interp_set.append(best_interp)
-        mean_sq_dist = geo_mean_sq_dist(interp_set)
-        if mean_sq_dist < best_dist:
-            best = interp_set
-            best_dist = mean_sq_dist
+    # proximity testing.  for each seed, collect the closest interpretation
+    # of each other toponym and measure the distance of each to the centroid
+    # of the collection.  collection that minimizes the sum of square
+    # distances "wins" and the respective interpretations are selected by the
+    # "proximity" method (see proximity module)
+    best = proximity.most_proximate(interpretations, weights)
 
     # annotate likely interpretations with 'prox_likely' attribute
     for i in best:
@@ -235,6 +241,13 @@ def add_proximity_resolution(interpretations):
     return
 
 
+def resolve_assignment(grid, geonames, assignment, method):
+    """Returns all interpretations of each cell of the grid, given the
+    category assignment of its columns"""
+    resolver = Resolver(grid, geonames, assignment, method=method)
+    return resolver.get_all_interpretations(method=method)
+
+
 class Resolver(object):
     def __init__(self, grid=None, geonames=None, assignment=None, method=None):
         self.grid = grid
@@ -270,17 +283,51 @@ class Resolver(object):
         method parameter specifies resolution method.  It can be one of three
         values: ['prominence', 'proximity', 'both'].
         """
-        method = method or self.method or 'proximity'
+        # repeated cell values are resolved once (and weighted by their
+        # number of occurrences for proximity resolution)
+        values = unique_values(column)
+        interpretations = self.get_value_interpretations(
+            values, cat, fetch_all=fetch_all, method=method)
+
+        # flatten list, in row order (rows with the same value share the same
+        # interpretation dicts)
+        value_interpretations = dict(zip([v for v, w in values],
+                                         interpretations))
+        flat_interpretations = []
+        for cell in column:
+            flat_interpretations.extend(value_interpretations[cell])
+
+        return flat_interpretations
+
+    def get_value_interpretations(self, values, cat, fetch_all=False,
+                                  method=None, cache=None):
+        """Like _get_col_interpretations, for a column given as (value, number
+        of occurrences) pairs.  Returns the interpretations of each value.
 
+        cache, if given, is a dict of the interpretations of values within
+        cat (from earlier calls with the same method), which are reused
+        rather than recomputed.  New values are added to it."""
+        method = method or self.method or 'proximity'
         interpretations = []
 
-        for cell in column:
+        for cell, weight in values:
+            if cache is not None and cell in cache:
+                cell_interpretations = cache[cell]
+                # cleared, as proximity resolution depends on the other values
+                for i in cell_interpretations:
+                    i.pop('prox_likely', None)
+                if fetch_all:
+                    interpretations.append(cell_interpretations)
+                else:
+                    interpretations.append([cell_interpretations[0]])
+                continue
+
             cell_interpretations = []
             for g in self.geonames.get_by_name(cell):
                 g_cat = self.geonames.get_category(g)
-                if category.satisfies_s(g_cat, cat['category']):
+                if LATTICE.satisfies(g_cat, cat['category']):
                     return_val = dict(g)
-                    return_val['cat'] = g_cat
+                    return_val['cat'] = LATTICE.to_s(g_cat)
                     if return_val['name'] != cell:
                         return_val['full_name'] = cell
                     cell_interpretations.append(return_val)
@@ -289,6 +336,8 @@ class Resolver(object):
             if method in ['both', 'prominence']:
                 if len(cell_interpretations) > 0:
                     cell_interpretations[0]['likely'] = True
+            if cache is not None:
+                cache[cell] = cell_interpretations
 
             if fetch_all:
                 interpretations.append(cell_interpretations)
@@ -296,14 +345,9 @@ class Resolver(object):
                 interpretations.append([cell_interpretations[0]])
 
         if method in ['both', 'proximity']:
-            add_proximity_resolution(interpretations)
+            add_proximity_resolution(interpretations, [w for v, w in values])
 
-        # flatten list
-        flat_interpretations = []
-        for i in interpretations:
-            flat_interpretations.extend(i)
-
-        return flat_interpretations
+        return interpretations
 
 
 class ColumnClassifier(object):
@@ -313,6 +357,14 @@ class ColumnClassifier(object):
         self.taxonomy = taxonomy
         self.verbose = verbose
 
+    def lookup(self, strings):
+        """Fetches gazetteer entries for strings, returning a Lookup that
+        categorizes them with the classifier's taxonomy"""
+        categorize_func = lambda x: LATTICE.from_l(
+            self.taxonomy.categorize(x)
+        )
+        return self.gaz.lookup(strings, categorize_func)
+
     def train(self, training_set):
         """Given a list of (grid, categories) as the training set, find
         appropriate category ratings"""
@@ -323,10 +375,7 @@ class ColumnClassifier(object):
                 true_category = [true_category]
             # Get category candidates for each column
             all_strings = [s for col in grid for s in col]
-            categorize_func = lambda x: category.l_to_s(
-                self.taxonomy.categorize(x)
-            )
-            geonames = self.gaz.lookup(all_strings, categorize_func)
+            geonames = self.lookup(all_strings)
             grid_candidates = Categorizer(
                 grid, geonames, self.taxonomy
             ).get_top_categories()
@@ -339,7 +388,8 @@ class ColumnClassifier(object):
 
         # cats_match function expects x to have full category strings,
         # y has suffixes (i.e., the child node for each dimension)
-        cats_match = lambda x, y: all(c.endswith(t) for c, t in zip(x, y))
+        cats_match = lambda x, y: all(LATTICE.strings[c].endswith(t)
+                                      for c, t in zip(x, y))
 
         for i, res in enumerate(cat_list):
             if cats_match(res['category'], true_cat):
@@ -348,7 +398,8 @@ class ColumnClassifier(object):
         if winner_idx is not None:
             self.add_training_samples(winner_idx, cat_list)
         else:
-            print >> sys.stderr, 'No winner found for %r (%r)' % (cat_list, true_cat)
+            print >> sys.stderr, 'No winner found for %r (%r)' % (
+                [export_category_result(c) for c in cat_list], true_cat)
 
     def add_training_samples(self, winner, candidates):
         raise NotImplementedError
@@ -356,54 +407,232 @@ class ColumnClassifier(object):
     def geotag_full(self, grid, **options):
         resolution_method = options.get('resolution_method', 'both')
         single_category = options.get('single_category', False)
+        # number of assignments whose interpretations are resolved up front
+        # (None for all).  each result includes a 'resolve' function to
+        # resolve the interpretations later.
+        max_resolved = options.get('max_resolved')
+        # number of category assignments returned
+        top = 1 if single_category else options.get('top', 20)
+        # Lookup to use instead of querying the gazetteer (e.g., shared by a
+        # batch of grids); it must include all strings of the grid
+        geonames = options.get('geonames')
+        # initial number of sampled cells for choosing each column's
+        # categories (None to use all cells)
+        sample_size = options.get('sample_size')
+        sample_tolerance = options.get('sample_tolerance', SAMPLE_TOLERANCE)
 
         if grid and isinstance(grid[0], basestring):
             grid = [grid]
-        all_strings = [s for col in grid for s in col]
-        categorize_func = lambda x: category.l_to_s(
-            self.taxonomy.categorize(x)
-        )
-        geonames = self.gaz.lookup(all_strings, categorize_func)
-
-        # Determine possible categories for each column
-        grid_candidates = Categorizer(
-            grid, geonames, self.taxonomy
-        ).get_top_categories()
+        if geonames is None:
+            all_strings = [s for col in grid for s in col]
+            geonames = self.lookup(all_strings)
 
-        # Determine most likely categories for each column
-        category_lists = []
-        for column, candidates in zip(grid, grid_candidates):
-            category_lists.append(self._classify_column(column, candidates))
+        if sample_size:
+            category_lists = [
+                self._classify_sampled_column(column, geonames, sample_size,
+                                              sample_tolerance)
+                for column in grid]
+        else:
+            # Determine possible categories for each column
+            grid_candidates = Categorizer(
+                grid, geonames, self.taxonomy
+            ).get_top_categories()
 
+            # Determine most likely categories for each column
+            category_lists = []
+            for column, candidates in zip(grid, grid_candidates):
+                category_lists.append(self._classify_column(column,
+                                                            candidates))
+
+        return self._geotag_results(
+            category_lists, top, max_resolved,
+            functools.partial(resolve_assignment, grid, geonames,
+                              method=resolution_method))
+
+    def _geotag_results(self, category_lists, top, max_resolved,
+                        resolve_func):
+        """Builds the results of geotag_full from the category lists of the
+        columns.  resolve_func(assignment) returns the interpretations of
+        the cells given an assignment."""
         # Determine most likely category assignments for all columns in grid
-        a_list = self._get_likely_category_assignments(category_lists)
+        a_list = self._get_likely_category_assignments(category_lists, top=top)
         assignments = []
         for a_idxs, a_prob in a_list:
             a = ([c[i] for c, i in zip(category_lists, a_idxs) if c], a_prob)
             assignments.append(a)
 
-        if single_category:
-            assignments = assignments[:1]
-
         # Determine most likely interpretations for each toponym given
         # assignment
         geotag_results = []
-        for assignment, a_prob in assignments:
-            resolver = Resolver(grid, geonames, assignment,
-                                method=resolution_method)
-            interpretations = resolver.get_all_interpretations(method=resolution_method)
+        for i, (assignment, a_prob) in enumerate(assignments):
+            resolve = functools.partial(resolve_func, assignment)
+            if max_resolved is None or i < max_resolved:
+                interpretations = resolve()
+            else:
+                interpretations = None
             c = None
             #c = [geo_centroid([(g['latitude'], g['longitude'])
             #                   for g in i if 'likely' in g])
             #     for i in interpretations]
-            geotag_results.append({'categories': assignment,
+            geotag_results.append({'categories': [export_category_result(c)
+                                                  for c in assignment],
                                    'likelihood': a_prob,
                                    'cell_interpretations': interpretations,
+                                   'resolve': resolve,
                                    'centroid': c})
 
         return geotag_results
 
+    def _classify_sampled_column(self, column, geonames, sample_size,
+                                 tolerance):
+        """Classifies a column using a random sample of its cells.
+
+        The sample starts with sample_size cells and is doubled until the top
+        category is unchanged and the margin between the normalized_prob of
+        the top two categories changes by no more than tolerance (or the
+        sample is the whole column).  Each category result includes 'sample',
+        with the sample size and the standard error of its estimated coverage
+        ratio (category stats are computed over the sample)."""
+        n = len(column)
+        categorizer = Categorizer(None, geonames, self.taxonomy)
+        # repeated values are only categorized once, so a sample saves
+        # nothing unless the column has more distinct values than sample_size
+        values = unique_values(column)
+        if len(values) <= sample_size:
+            candidates = categorizer.get_top_value_categories(values, n)
+            category_list = self._classify_column(column, candidates)
+            for c in category_list:
+                c['sample'] = {'size': n, 'error': 0.0}
+            return category_list
+
+        # partially shuffled row indexes: each prefix order[:size] is a
+        # uniform random sample, and growing the sample keeps earlier cells
+        order = range(n)
+        rnd = random.Random(0)
+        shuffled = 0
+        size = sample_size
+        last = None
+        while True:
+            for i in xrange(shuffled, size):
+                j = rnd.randint(i, n - 1)
+                order[i], order[j] = order[j], order[i]
+            shuffled = size
+
+            sample = [column[i] for i in order[:size]]
+            candidates = categorizer.get_top_value_categories(
+                unique_values(sample), size)
+            category_list = self._classify_column(sample, candidates)
+
+            probs = [c['normalized_prob'] for c in category_list[:2]] + [0, 0]
+            top = category_list[0]['category'] if category_list else None
+            margin = probs[0] - probs[1]
+            if size == n or (last is not None and last[0] == top and
+                             abs(margin - last[1]) <= tolerance):
+                break
+            last = (top, margin)
+            size = min(size * 2, n)
+
+        # finite population correction, as the sample is drawn without
+        # replacement
+        fpc = float(n - size) / (n - 1) if n > 1 else 0.0
+        for c in category_list:
+            p = float(c['stats']['coverage']) / size
+            c['sample'] = {'size': size,
+                           'error': math.sqrt(p * (1 - p) / size * fpc)}
+        return category_list
+
+    def geotag_stream(self, rows, **options):
+        """Geotags a single column, given as an iterable of strings, without
+        materializing it.
+
+        Rows are read chunk_size at a time; new distinct values are looked up
+        as they appear, and only the number of occurrences of each value is
+        kept.  The column category is chosen once all rows are read.
+        Returns a dict with the category result (as in geotag_full), the
+        number of rows, 'interpretations', a function returning the (full)
+        interpretations of a value, and 'chunks', a function returning a
+        generator of lists of the interpretations of chunk_size rows at a
+        time, in row order.
+
+        Nothing is kept per row, so chunks reads the rows a second time: rows
+        itself if it can be iterated again (e.g., a list), otherwise (e.g., a
+        file or generator) the rows passed to chunks."""
+        resolution_method = options.get('resolution_method', 'both')
+        chunk_size = options.get('chunk_size', 10000)
+
+        it = iter(rows)
+        source = None if it is rows else rows
+        geonames = self.lookup([])
+        index = {}
+        values = []
+        weights = []
+        while True:
+            chunk = list(itertools.islice(it, chunk_size))
+            if not chunk:
+                break
+            new_values = []
+            for v in chunk:
+                i = index.get(v)
+                if i is None:
+                    i = index[v] = len(values)
+                    values.append(v)
+                    weights.append(0)
+                    new_values.append(v)
+                weights[i] += 1
+            if new_values:
+                geonames.add_strings(new_values)
+        total = sum(weights)
+
+        value_counts = zip(values, weights)
+        candidates = Categorizer(
+            None, geonames, self.taxonomy
+        ).get_top_value_categories(value_counts, total)
+        category_list = self._classify_column(None, candidates)
+        a_list = self._get_likely_category_assignments([category_list], top=1)
+        if a_list and category_list:
+            (cat_idx,), likelihood = a_list[0]
+            cat = category_list[cat_idx]
+        else:
+            cat, likelihood = None, 0.0
+
+        # interpretations of each distinct value, resolved (together, for
+        # proximity resolution) when first needed
+        resolved = []
+
+        def interpretations(value):
+            if not resolved:
+                if cat is None:
+                    resolved.append([[] for v in values])
+                else:
+                    resolved.append(Resolver(
+                        None, geonames, [cat], method=resolution_method
+                    ).get_value_interpretations(value_counts, cat,
+                                                fetch_all=True,
+                                                method=resolution_method))
+            i = index.get(value)
+            return [] if i is None else resolved[0][i]
+
+        def chunks(rows=None):
+            if rows is None:
+                rows = source
+            if rows is None:
+                raise ValueError('rows were read from an iterator; pass them '
+                                 'to chunks again')
+            row_it = iter(rows)
+            while True:
+                chunk = list(itertools.islice(row_it, chunk_size))
+                if not chunk:
+                    return
+                yield [interpretations(v) for v in chunk]
+
+        return {'categories': [export_category_result(cat)] if cat else [],
+                'likelihood': likelihood,
+                'rows': total,
+                'interpretations': interpretations,
+                'chunks': chunks}
+
     def geotag_grid(self, grid, **options):
+        options.setdefault('max_resolved', 1)
         full_results = self.geotag_full(grid, **options)
         return full_results[0]
 
@@ -429,13 +658,225 @@ class ColumnClassifier(object):
         raise NotImplementedError
 
 
+class SessionColumn(object):
+    """Incrementally maintained state of one column of a GridSession"""
+    def __init__(self):
+        self.values = {}  # value -> number of rows
+        self.counts = {}  # category -> [coverage, log sum] (see Categorizer)
+        self.category_list = None  # classified candidates (None if stale)
+        self.total = None  # number of rows when category_list was computed
+        self.interpretations = {}  # category -> {value: interpretations}
+
+
+class GridSession(object):
+    """Geotags a grid whose rows are inserted and deleted over time.
+
+    The Lookup of all values seen so far is kept and extended with new
+    values only.  For each column, the number of rows with each value and
+    the category counts of Categorizer are updated as rows change, so
+    candidates and classifications are recomputed from the counts (and only
+    for changed columns).  The interpretations of each value within a column
+    category are kept, so only new values are resolved (proximity resolution
+    is redone over all values).  Returned interpretation dicts are shared
+    with the session, and reflect its latest resolution."""
+
+    def __init__(self, classifier, resolution_method=None):
+        self.classifier = classifier
+        self.resolution_method = resolution_method
+        self.geonames = classifier.lookup([])
+        self.categorizer = Categorizer(None, self.geonames,
+                                       classifier.taxonomy)
+        self.rows = []
+        self.columns = []
+
+    def _count(self, column, value, n):
+        # add (or, for negative n, remove) n rows with value to column
+        rows = column.values.get(value, 0) + n
+        if rows:
+            column.values[value] = rows
+        else:
+            del column.values[value]
+        counts = column.counts
+        for cat, cnt in self.categorizer._cell_histogram(value).iteritems():
+            c = counts.get(cat)
+            if c is None:
+                counts[cat] = [n, n * log_count(cnt)]
+            elif c[0] + n == 0:
+                del counts[cat]
+            else:
+                c[0] += n
+                c[1] += n * log_count(cnt)
+        column.category_list = None
+
+    def insert_rows(self, index, rows):
+        """Inserts rows (lists of cell values) before row index"""
+        rows = [tuple(r) for r in rows]
+        if not rows:
+            return
+        self.geonames.add_strings([s for r in rows for s in r])
+        width = max(len(r) for r in rows)
+        while len(self.columns) < width:
+            # shorter rows have empty cells
+            column = SessionColumn()
+            if self.rows:
+                self._count(column, u'', len(self.rows))
+            self.columns.append(column)
+        for j, column in enumerate(self.columns):
+            for value, n in unique_values([r[j] if j < len(r) else u''
+                                           for r in rows]):
+                self._count(column, value, n)
+        self.rows[index:index] = rows
+
+    def delete_rows(self, start, stop):
+        """Deletes rows start to stop (exclusive)"""
+        rows = self.rows[start:stop]
+        for j, column in enumerate(self.columns):
+            for value, n in unique_values([r[j] if j < len(r) else u''
+                                           for r in rows]):
+                self._count(column, value, -n)
+        del self.rows[start:stop]
+
+    def grid(self):
+        return [[r[j] if j < len(r) else u'' for r in self.rows]
+                for j in range(len(self.columns))]
+
+    def geotag_full(self, max_resolved=None, top=20):
+        """Geotags the current rows, as ColumnClassifier.geotag_full"""
+        total = len(self.rows)
+        category_lists = []
+        for column in self.columns:
+            # (coverage ratios of every column change with the number of
+            # rows)
+            if column.category_list is None or column.total != total:
+                candidates = self.categorizer._top_categories(column.counts,
+                                                              total)
+                column.category_list = self.classifier._classify_column(
+                    None, candidates)
+                column.total = total
+                cats = set(c['category'] for c in column.category_list)
+                for cat in column.interpretations.keys():
+                    if cat not in cats:
+                        del column.interpretations[cat]
+            category_lists.append(column.category_list)
+
+        return self.classifier._geotag_results(
+            category_lists, top, max_resolved,
+            functools.partial(self._resolve, self.grid()))
+
+    def _resolve(self, grid, assignment):
+        resolver = Resolver(grid, self.geonames, assignment,
+                            method=self.resolution_method)
+        results = []
+        for column, state, cat in zip(grid, self.columns, assignment):
+            values = unique_values(column)
+            cache = state.interpretations.setdefault(cat['category'], {})
+            interpretations = resolver.get_value_interpretations(
+                values, cat, fetch_all=True, cache=cache)
+            value_interpretations = dict(zip([v for v, w in values],
+                                             interpretations))
+            flat_interpretations = []
+            for cell in column:
+                flat_interpretations.extend(value_interpretations[cell])
+            results.append(flat_interpretations)
+        return results
+
+
+def pseudo_sums(vals):
+    return (len(vals), sum(vals), sum(v * v for v in vals))
+
+
+def mean_var(n, sum1, sum2):
+    """Sample mean and variance, given count, sum and sum of squares"""
+    mean = float(sum1) / n
+    variance = (sum2 - sum1 * mean) / (n - 1)
+    return (mean, variance)
+
+
+# pseudocounts seeding the coverage ratios of each feature value, to correct
+# for small sample size: winning samples (t1), winner/total counts (t2) and
+# all samples (t3)
+T1_PSEUDO = pseudo_sums([1.0, 0.5])
+T2_PSEUDO = (2, 4)
+T3_PSEUDO = pseudo_sums([1.0, 0.5, 0.6, 0.1])
+
+
+class FeatureValueStats(object):
+    """Sufficient statistics of the training samples that share a value of
+    one feature: sample and winner counts, and sums (and sums of squares) of
+    their coverage ratios"""
+    __slots__ = ['n', 'n_win', 'sum_all', 'sumsq_all', 'sum_win', 'sumsq_win']
+
+    def __init__(self):
+        self.n = self.n_win = 0
+        self.sum_all = self.sumsq_all = self.sum_win = self.sumsq_win = 0.0
+
+    def add(self, is_winner, ratio):
+        self.n += 1
+        self.sum_all += ratio
+        self.sumsq_all += ratio * ratio
+        if is_winner:
+            self.n_win += 1
+            self.sum_win += ratio
+            self.sumsq_win += ratio * ratio
+
+    def params(self):
+        """Returns (t1 mean, t1 variance, t2 term, t3 mean, t3 variance) used
+        by BayesClassifier._feature_prob"""
+        t1_mean, t1_var = mean_var(T1_PSEUDO[0] + self.n_win,
+                                   T1_PSEUDO[1] + self.sum_win,
+                                   T1_PSEUDO[2] + self.sumsq_win)
+        t2_term = (float(T2_PSEUDO[0] + self.n_win) /
+                   (T2_PSEUDO[1] + self.n))
+        t3_mean, t3_var = mean_var(T3_PSEUDO[0] + self.n,
+                                   T3_PSEUDO[1] + self.sum_all,
+                                   T3_PSEUDO[2] + self.sumsq_all)
+        return (t1_mean, t1_var, t2_term, t3_mean, t3_var)
+
+
+def log_prob_density(mean, variance, val):
+    """Log of the normal density (BayesClassifier._get_prob_density),
+    elementwise over NumPy arrays"""
+    return (-0.5 * numpy.log(math.pi * 2 * variance) -
+            (val - mean) ** 2 / (2 * variance))
+
+
+# version of the file layout written by BayesClassifier.save_model
+MODEL_FORMAT_VERSION = 2
+
+# types of the feature values that can be saved (besides tuples of them)
+FEATURE_VALUE_TYPES = (basestring, bool, int, long, float, type(None))
+
+
+def decode_feature_value(v):
+    """Converts a feature value read from a model file back to the value
+    returned by the feature function (tuples are saved as JSON lists).
+    Raises ValueError for values no feature function returns."""
+    if isinstance(v, list):
+        return tuple(decode_feature_value(x) for x in v)
+    if not isinstance(v, FEATURE_VALUE_TYPES):
+        raise ValueError('unexpected feature value %r' % (v,))
+    return v
+
+
 class BayesClassifier(ColumnClassifier):
+    # score candidates with NumPy array operations when it is installed
+    # (otherwise, or when verbose, the pure-Python path is used)
+    use_numpy = numpy is not None
+
     def __init__(self, *args, **kwargs):
-        self.model = []
+        # training statistics for each (feature index, feature value)
+        self.feature_stats = {}
         self.feature_funcs = []
-        self._cache_prob = {}
+        self._default_params = FeatureValueStats().params()
+        self._clear_params()
         super(BayesClassifier, self).__init__(*args, **kwargs)
 
+    def _clear_params(self):
+        # derived feature parameters, recomputed after training
+        self._feature_params = {}
+        self._param_index = None
+        self._param_table = None
+
     def set_feature_funcs(self, func_list):
         self.feature_funcs = func_list
 
@@ -450,18 +891,77 @@ class BayesClassifier(ColumnClassifier):
             # compute feature funcs for category
             func_vals = [f(cat, stats) for f in self.feature_funcs]
 
-            instance = (i == winner_idx,
-                        stats['coverage'],
-                        stats['total'],
-                        func_vals)
+            ratio = 1.0 * stats['coverage'] / stats['total']
+            for f_idx, f_val in enumerate(func_vals):
+                if (f_idx, f_val) not in self.feature_stats:
+                    self.feature_stats[(f_idx, f_val)] = FeatureValueStats()
+                self.feature_stats[(f_idx, f_val)].add(i == winner_idx, ratio)
+
             if i == winner_idx:
                 if self.verbose:
                     print 'Found true category:'
                     print cat, stats
-            self.model.append(instance)
 
-        # clear model cache
-        self._cache_prob = {}
+        self._clear_params()
+
+    def save_model(self, filename, fingerprint):
+        """Saves the training statistics to filename, as JSON, along with a
+        fingerprint of everything they depend on (see load_model)"""
+        model = {
+            'format': MODEL_FORMAT_VERSION,
+            'fingerprint': fingerprint,
+            'feature_stats': [
+                [f_idx, f_val,
+                 [getattr(s, a) for a in FeatureValueStats.__slots__]]
+                for (f_idx, f_val), s in self.feature_stats.iteritems()],
+        }
+        # write to a temporary file and rename, so that concurrently starting
+        # processes never read a partially written model
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            json.dump(model, f)
+        os.rename(tmp_filename, filename)
+
+    def load_model(self, filename, fingerprint):
+        """Loads training statistics saved by save_model.  Returns False,
+        leaving the classifier unchanged, if the file is missing, is not a
+        valid model, or was saved with a different fingerprint.  The file is
+        only ever parsed as JSON data, so it need not be trusted."""
+        if not os.path.exists(filename):
+            return False
+        try:
+            with open(filename, 'rb') as f:
+                model = json.load(f)
+            if not isinstance(model, dict):
+                raise ValueError('not a JSON object')
+        except (IOError, ValueError) as e:
+            print >> sys.stderr, 'Could not read model %s (%s)' % (filename, e)
+            return False
+        if (model.get('format') != MODEL_FORMAT_VERSION or
+                model.get('fingerprint') != fingerprint):
+            print >> sys.stderr, 'Model %s is stale; retraining' % (filename,)
+            return False
+
+        try:
+            feature_stats = {}
+            for f_idx, f_val, values in model['feature_stats']:
+                if (not isinstance(f_idx, int) or
+                        len(values) != len(FeatureValueStats.__slots__) or
+                        not all(isinstance(v, (int, long, float)) and
+                                not isinstance(v, bool) for v in values)):
+                    raise ValueError('bad statistics for feature %r' %
+                                     (f_idx,))
+                stats = FeatureValueStats()
+                for a, v in zip(FeatureValueStats.__slots__, values):
+                    setattr(stats, a, v)
+                feature_stats[(f_idx, decode_feature_value(f_val))] = stats
+        except (KeyError, TypeError, ValueError) as e:
+            print >> sys.stderr, 'Could not read model %s (%s)' % (filename, e)
+            return False
+
+        self.feature_stats = feature_stats
+        self._clear_params()
+        return True
 
     #def geotag_full(self, *args, **kwargs):
     #    return super(BayesClassifier, self).geotag_full(*args, **kwargs)
@@ -473,6 +973,9 @@ class BayesClassifier(ColumnClassifier):
         # output:
         #  - list of category/stats/probabilities, sorted by probability desc
 
+        if self.use_numpy and not self.verbose:
+            return self._classify_column_numpy(candidates)
+
         results = []
         for res in candidates:
             cat = res['category']
@@ -516,47 +1019,74 @@ class BayesClassifier(ColumnClassifier):
                       key=lambda x: x['normalized_prob'],
                       reverse=True)
 
-    def _feature_prob(self, f_idx, f_val, cov, tot):
-        if (f_idx, f_val, cov, tot) in self._cache_prob:
-            return self._cache_prob.get((f_idx, f_val, cov, tot))
-
-        # seed with pseudocounts to correct for small sample size
-        t1 = [1.0, 0.5]
-        t2 = [True, True, False, False]
-        t3 = [1.0, 0.5, 0.6, 0.1]
-
-        for is_winner, sample_cov, sample_tot, func_vals in self.model:
-            if is_winner and func_vals[f_idx] == f_val:
-                t1.append(1.0 * sample_cov / sample_tot)
-
-            if func_vals[f_idx] == f_val:
-                t2.append(is_winner)
-
-            if func_vals[f_idx] == f_val:
-                t3.append(1.0 * sample_cov / sample_tot)
+    def _numpy_param_tables(self):
+        """Returns a dict of row numbers for each (feature index, feature
+        value) seen in training, and an array of their parameters (see
+        FeatureValueStats.params).  Row 0 holds the default parameters."""
+        if self._param_table is None:
+            keys = list(self.feature_stats)
+            self._param_index = dict((k, i + 1) for i, k in enumerate(keys))
+            self._param_table = numpy.array(
+                [self._default_params] +
+                [self.feature_stats[k].params() for k in keys])
+        return self._param_index, self._param_table
+
+    def _classify_column_numpy(self, candidates):
+        """Same as _classify_column, scoring all candidates at once"""
+        if not candidates:
+            return []
+        index, table = self._numpy_param_tables()
+
+        # (candidates x features) matrix of parameter rows
+        rows = numpy.array([
+            [index.get((i, f(res['category'], res['stats'])), 0)
+             for i, f in enumerate(self.feature_funcs)]
+            for res in candidates])
+        ratios = numpy.array([float(res['stats']['coverage']) /
+                              res['stats']['total'] for res in candidates])
+
+        params = table[rows]
+        t1_mean, t1_var, t2_term, t3_mean, t3_var = [
+            params[:, :, i] for i in range(5)]
+        x = ratios[:, numpy.newaxis]
+        log_probs = (numpy.log(t2_term) +
+                     log_prob_density(t1_mean, t1_var, x) -
+                     log_prob_density(t3_mean, t3_var, x)).sum(axis=1)
+        final_probs = numpy.exp(log_probs)
+        assert ((0 <= final_probs) & (final_probs <= 1)).all()
+
+        # scale and normalize probs
+        log_sum = numpy.logaddexp.reduce(log_probs)
+        scaled_probs = numpy.exp(0.75 * (log_probs - log_sum))
+        normalized_probs = scaled_probs / scaled_probs.sum()
+
+        results = [{'category': res['category'],
+                    'stats': res['stats'],
+                    'final_prob': float(final_probs[i]),
+                    'scaled_prob': float(scaled_probs[i]),
+                    'normalized_prob': float(normalized_probs[i])}
+                   for i, res in enumerate(candidates)]
+        return sorted(results,
+                      key=lambda x: x['normalized_prob'],
+                      reverse=True)
 
-        # compute mean, variance of t1, t3
-        t1_mean, t1_var = self._get_mean_var(t1)
-        t3_mean, t3_var = self._get_mean_var(t3)
+    def _feature_prob(self, f_idx, f_val, cov, tot):
+        params = self._feature_params.get((f_idx, f_val))
+        if params is None:
+            stats = self.feature_stats.get((f_idx, f_val))
+            if stats is None:
+                # value not seen in training, only pseudocounts apply
+                params = self._default_params
+            else:
+                params = stats.params()
+                self._feature_params[(f_idx, f_val)] = params
+        t1_mean, t1_var, t2_term, t3_mean, t3_var = params
 
         # compute individual probabilities
         t1_term = self._get_prob_density(t1_mean, t1_var, float(cov) / tot)
-        t2_term = float(t2.count(True)) / len(t2)
         t3_term = self._get_prob_density(t3_mean, t3_var, float(cov) / tot)
 
-        res = t1_term * t2_term / t3_term
-        self._cache_prob[(f_idx, f_val, cov, tot)] = res
-        return res
-
-    def _get_mean_var(self, vals):
-        n = len(vals)
-        sum1 = sum(vals)
-        mean = float(sum1) / n
-
-        sum2 = sum((x - mean) ** 2 for x in vals)
-        variance = float(sum2) / (n - 1)
-
-        return (mean, variance)
+        return t1_term * t2_term / t3_term
 
     def _get_prob_density(self, mean, variance, val):
         density = float(1) / (math.sqrt(math.pi * 2 * variance))
@@ -565,39 +1095,54 @@ class BayesClassifier(ColumnClassifier):
 
     def _get_likely_category_assignments(self, category_lists, top=20):
         """
-        Returns list of top assignments, by probability.
+        Returns list of top assignments, by probability.  Each category list
+        must be sorted by probability desc; empty lists (columns without
+        candidates) do not affect assignment probability.
 
         For example, given [[0.9, 0.05, 0.04, 0.01], [0.6, 0.4]],
         The result should be:
-            [([0, 0], 0.54(=0.9*0.6)), ([0, 1], 0.54)], ([1, 0], .03), ...]
+            [([0, 0], 0.54(=0.9*0.6)), ([0, 1], 0.36), ([1, 0], .03), ...]
         """
-        # create priority queue seeded with most likely assignment (top
-        # category for each column)
-        pq = []
-
-        def probs(indexes):
-            return [p[idx]['normalized_prob']
-                    for idx, p in zip(indexes, category_lists)
-                    if len(p) > idx + 1]
-
-        def assignment_prob(indexes):
-            return product(probs(indexes))
-
-        start_indexes = [0] * len(category_lists)
-
-        heapq.heappush(pq, (-assignment_prob(start_indexes), start_indexes))
+        # (for an assignment using the (n+1)-th category of a column, at least
+        # n others are as likely, so only the first top categories matter)
+        log_probs = [[log(c['normalized_prob']) for c in p[:top]]
+                     for p in category_lists]
+        # columns with more than one candidate category
+        branching = [i for i, l in enumerate(log_probs) if len(l) > 1]
+
+        # best-first search, starting from the most likely assignment (top
+        # category for each column).  every other assignment has a single
+        # parent: the assignment with its last non-zero index decremented.
+        # children are no more likely than their parent, so assignments are
+        # popped in order of probability, and none is pushed twice.  queue
+        # entries hold (-log prob, sequence number, parent indexes, changed
+        # column, position of changed column in branching), so index lists
+        # are only built for the assignments that are returned.
+        start_log_prob = sum(l[0] for l in log_probs if l)
+        pq = [(-start_log_prob, 0, None, None, 0)]
+        pushed = 1
 
         results = []
-        while len(results) < top and len(pq) > 0:
-            cur_prob, cur_indexes = heapq.heappop(pq)
-
-            results.append((cur_indexes, -cur_prob))
-            for i in range(len(cur_indexes)):
-                next_indexes = cur_indexes[:]
-                # add next category at current column index if it exists
-                next_indexes[i] += 1
-                if next_indexes[i] < len(category_lists[i]):
-                    heapq.heappush(pq, (-assignment_prob(next_indexes),
-                                        next_indexes))
+        while pq:
+            neg_log_prob, _, parent, col, pos = heapq.heappop(pq)
+            if parent is None:
+                indexes = [0] * len(category_lists)
+            else:
+                indexes = parent[:]
+                indexes[col] += 1
+            results.append((indexes, math.exp(-neg_log_prob)))
+            if len(results) >= top:
+                break
+
+            for b in range(pos, len(branching)):
+                i = branching[b]
+                idx = indexes[i]
+                if idx + 1 >= len(log_probs[i]):
+                    continue
+                next_log_prob = log_probs[i][idx + 1]
+                if next_log_prob != float('-inf'):
+                    next_log_prob += -neg_log_prob - log_probs[i][idx]
+                heapq.heappush(pq, (-next_log_prob, pushed, indexes, i, b))
+                pushed += 1
 
         return results
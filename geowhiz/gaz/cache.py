@@ -0,0 +1,93 @@
+import sys
+
+import geowhiz
+from geowhiz.lru import LRUCache
+
+
+def entry_size(entry):
+    """Approximate memory used by a cache entry (list of geoname dicts and
+    category histogram), in bytes"""
+    records, histogram = entry
+    size = sys.getsizeof(records)
+    for r in records:
+        size += sys.getsizeof(r) + sum(sys.getsizeof(v)
+                                       for v in r.itervalues())
+    if histogram is not None:
+        size += sys.getsizeof(histogram) + sum(
+            sys.getsizeof(cat) + sum(sys.getsizeof(n) for n in cat)
+            for cat in histogram)
+    return size
+
+
+class cachedGaz(geowhiz.Gazetteer):
+    """Wraps another gazetteer with a cache of get_geoname_info results that
+    is shared across requests.
+
+    Results (and precomputed category histograms) are cached per lookup
+    string, including strings that have no match.  Cached geoname dicts and
+    histograms are shared, so callers must copy them before making changes
+    (Lookup already does).  All other methods are
+    passed through to the wrapped gazetteer.
+    """
+    def __init__(self, gaz, max_entries=100000, max_bytes=None):
+        self.gaz = gaz
+        self.cache = LRUCache(max_entries, max_bytes, weigh=entry_size)
+
+    def __getattr__(self, name):
+        return getattr(self.gaz, name)
+
+    @property
+    def taxonomy_version(self):
+        return self.gaz.taxonomy_version
+
+    def fingerprint(self):
+        return self.gaz.fingerprint()
+
+    def get_container_names(self, level, keys=None):
+        return self.gaz.get_container_names(level, keys)
+
+    def get_types(self):
+        return self.gaz.get_types()
+
+    def get_type_text(self):
+        return self.gaz.get_type_text()
+
+    def get_geoname_info(self, strings):
+        res = []
+        missing = []
+        for s in strings:
+            entry = self.cache.get(s)
+            if entry is None:
+                missing.append(s)
+            else:
+                res.extend(entry[0])
+
+        if missing:
+            by_name = dict((s, []) for s in missing)
+            for r in self.gaz.get_geoname_info(missing):
+                if r['name'] in by_name:
+                    by_name[r['name']].append(r)
+                res.append(r)
+            histograms = self.gaz.get_category_histograms(missing)
+            for s, records in by_name.iteritems():
+                self.cache.put(s, (records, histograms.get(s)))
+
+        return res
+
+    def get_category_histograms(self, strings):
+        res = {}
+        missing = []
+        for s in strings:
+            entry = self.cache.peek(s)
+            if entry is None:
+                missing.append(s)
+            elif entry[1] is not None:
+                res[s] = entry[1]
+        if missing:
+            res.update(self.gaz.get_category_histograms(missing))
+        return res
+
+    def cache_stats(self):
+        """Hit/miss/eviction counts and approximate size (in bytes) of the
+        lookup cache"""
+        return self.cache.stats()
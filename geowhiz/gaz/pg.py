@@ -1,8 +1,28 @@
+"""
+PostgreSQL gazetteer, with GeoNames data in the gaz schema.
+
+Names are looked up in the gaz.name_lookup table if it exists, and in the
+geoname and altname tables otherwise (which is much slower).  Build it, after
+loading or updating the GeoNames data, with:
+
+    python -m geowhiz.gaz.pg db_name db_user db_host
+"""
+import argparse
+
 import psycopg2
 import psycopg2.extras
 import geowhiz
 
 GET_GAZ_DATA = """
+SELECT name, geonameid, official_name, altnames, latitude, longitude, fclass,
+       fcode, country, cc2, admin1, admin2, admin3, admin4, elevation,
+       population, continent
+  FROM gaz.name_lookup
+ WHERE name in (%s)
+""".strip()
+
+# legacy query for gazetteers without the gaz.name_lookup table
+GET_GAZ_DATA_UNION = """
 SELECT distinct * from (
     SELECT geonameid, name, name as official_name, altnames, latitude,
            longitude, fclass, fcode, country, cc2, admin1, admin2, admin3,
@@ -26,29 +46,120 @@ SELECT distinct * from (
  ORDER BY name
 """.strip()
 
+HAS_NAME_LOOKUP = """
+SELECT count(*) FROM information_schema.tables
+ WHERE table_schema = 'gaz' and table_name = 'name_lookup'
+""".strip()
+
+# denormalized (name, geoname) table, deduplicated at build time, mirroring
+# the name_lookup table built by update_gaz.py for the SQLite gazetteer
+CREATE_NAME_LOOKUP = """
+DROP TABLE IF EXISTS gaz.name_lookup;
+CREATE TABLE gaz.name_lookup AS
+SELECT u.name, g.geonameid, g.name as official_name,
+       coalesce(length(g.altnames) -
+                length(replace(g.altnames, ',', '')), 0) as altnames,
+       g.latitude, g.longitude, g.fclass, g.fcode, g.country, g.cc2,
+       g.admin1, g.admin2, g.admin3, g.admin4, g.elevation, g.population,
+       c.continent
+  FROM (SELECT name, geonameid FROM gaz.geoname
+        UNION
+        SELECT asciiname, geonameid FROM gaz.geoname
+        UNION
+        SELECT altname, geonameid FROM gaz.altname) u
+  JOIN gaz.geoname g ON (u.geonameid = g.geonameid)
+  LEFT JOIN gaz.country c ON (g.country = c.iso2)
+ WHERE u.name IS NOT NULL
+ ORDER BY u.name, g.geonameid;
+ALTER TABLE gaz.name_lookup ADD PRIMARY KEY (name, geonameid);
+CLUSTER gaz.name_lookup USING name_lookup_pkey;
+ANALYZE gaz.name_lookup;
+""".strip()
+
 GET_CONTINENTS = """
 SELECT iso2, name, continent from gaz.country;
 """.strip()
 
+# names of all containers of each level (see Gazetteer.get_container_names),
+# with the columns holding their codes
+GET_CONTAINER_NAMES = {
+    1: ("SELECT iso2, name FROM gaz.country WHERE true", ['iso2']),
+    2: ("SELECT country, admin1, name FROM gaz.admin1 WHERE true",
+        ['country', 'admin1']),
+    3: ("SELECT country, admin1, admin2, name FROM gaz.admin2 WHERE true",
+        ['country', 'admin1', 'admin2']),
+    4: ("SELECT country, admin1, admin2, admin3, name FROM gaz.geoname "
+        "WHERE fcode = 'ADM3'", ['country', 'admin1', 'admin2', 'admin3']),
+    5: ("SELECT country, admin1, admin2, admin3, admin4, name "
+        "FROM gaz.geoname WHERE fcode = 'ADM4'",
+        ['country', 'admin1', 'admin2', 'admin3', 'admin4']),
+}
+
 
 class pgGaz(geowhiz.Gazetteer):
+    """Gazetteer backed by a PostgreSQL database.  Uses gaz.name_lookup (see
+    create_name_lookup) when it exists."""
     def __init__(self, db_name, db_user, db_host):
         conn_str = 'dbname=%s user=%s host=%s' % (
             db_name, db_user, db_host
         )
         self.db_conn = psycopg2.connect(conn_str)
         self.continents = self._load_continents()
+        self.has_name_lookup = self._has_name_lookup()
 
     def _load_continents(self):
         cur = self.db_conn.cursor()
         cur.execute(GET_CONTINENTS)
         return dict((r[0], r[2]) for r in cur.fetchall())
 
+    def _has_name_lookup(self):
+        cur = self.db_conn.cursor()
+        cur.execute(HAS_NAME_LOOKUP)
+        return cur.fetchone()[0] > 0
+
+    def create_name_lookup(self):
+        """Builds (or rebuilds) the gaz.name_lookup table used by
+        get_geoname_info"""
+        cur = self.db_conn.cursor()
+        cur.execute(CREATE_NAME_LOOKUP)
+        self.db_conn.commit()
+        self.has_name_lookup = True
+
     def get_geoname_info(self, strings):
+        if not self.has_name_lookup:
+            return self._get_geoname_info_union(strings)
+        cur = self.db_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        param_sub = ', '.join('%s' for i in strings)
+        cur.execute(GET_GAZ_DATA % (param_sub,), strings)
+        return list(dict(r) for r in cur.fetchall())
+
+    def get_container_names(self, level, keys=None):
+        sql, columns = GET_CONTAINER_NAMES[level]
+        params = None
+        if keys is not None:
+            # narrow by the first and last code of each key, then keep only
+            # the requested keys
+            keys = set(keys)
+            if not keys:
+                return {}
+            sql = '%s AND %s = ANY(%%s) AND %s = ANY(%%s)' % (
+                sql, columns[0], columns[-1])
+            params = [list(set(k[0] for k in keys)),
+                      list(set(k[-1] for k in keys))]
+        cur = self.db_conn.cursor()
+        cur.execute(sql, params)
+        names = {}
+        for r in cur.fetchall():
+            k = tuple(r[:-1])
+            if r[-1] and k not in names and (keys is None or k in keys):
+                names[k] = r[-1]
+        return names
+
+    def _get_geoname_info_union(self, strings):
         cur = self.db_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         param_sub = ', '.join('%s' for i in strings)
         #print strings
-        get_gaz_data = GET_GAZ_DATA % (param_sub, param_sub, param_sub)
+        get_gaz_data = GET_GAZ_DATA_UNION % (param_sub, param_sub, param_sub)
         cur.execute(get_gaz_data, strings * 3)
 
         res = list(dict(r) for r in cur.fetchall())
@@ -57,3 +168,19 @@ class pgGaz(geowhiz.Gazetteer):
             r['continent'] = self.continents.get(r['country'])
 
         return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m geowhiz.gaz.pg',
+        description='Build the gaz.name_lookup table of a PostgreSQL '
+                    'gazetteer.')
+    parser.add_argument('db_name')
+    parser.add_argument('db_user')
+    parser.add_argument('db_host')
+    args = parser.parse_args(argv)
+    pgGaz(args.db_name, args.db_user, args.db_host).create_name_lookup()
+
+
+if __name__ == '__main__':
+    main()
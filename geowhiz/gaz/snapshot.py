@@ -0,0 +1,443 @@
+"""
+Read-only gazetteer served from a memory-mapped binary snapshot.
+
+The snapshot is written by update_gaz.py from the name_lookup, country,
+admin1, admin2, geoname and featurecodes tables.  It can be rewritten from an
+existing database (e.g. after include_georanks.py) with:
+
+    python -m geowhiz.gaz.snapshot gaz.db gaz.snapshot
+
+Layout (little-endian):
+
+    header       magic, format version, taxonomy version of the stored
+                 categories (0 if none), build id string, (offset, count) of
+                 every section
+    records      one fixed-width RECORD per geoname, sorted by geonameid,
+                 including its precomputed category strings
+    names        one NAME entry per distinct lookup name, sorted by name,
+                 with its encoded category histogram (if one was stored)
+    postings     record index (uint32) for every (name, geoname) pair
+    containers   (key string, name string) pairs, sorted by key
+    types        (fclass, fcode, name, description) string ids
+    type_text    (code, type, plural, description) string ids of the text
+                 of each type category, if stored
+    str_index    start offset (uint32) of every string, plus end sentinel
+    str_blob     utf8 string data
+
+Strings are referenced by id; NO_STRING stands for NULL.  The mapping is
+shared between processes, so forked web workers do not each hold their own
+copy of the gazetteer.
+"""
+import argparse
+import bisect
+import mmap
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+from array import array
+
+import geowhiz
+from geowhiz.category import decode_histogram
+from geowhiz.gazetteer import precomputed_categories_ok
+
+MAGIC = 'GWSNAP01'
+FORMAT_VERSION = 5
+
+HEADER = struct.Struct('<8sIII' + 'QI' * 8)
+RECORD = struct.Struct('<iIidd9IBqBq3I')
+NAME = struct.Struct('<IIII')
+CONTAINER = struct.Struct('<II')
+TYPE = struct.Struct('<4I')
+UINT = struct.Struct('<I')
+
+SECTIONS = ['records', 'names', 'postings', 'containers', 'types',
+            'type_text', 'str_index', 'str_blob']
+
+NO_STRING = 0xFFFFFFFF
+
+# tags for dynamically typed columns (sqlite may store '' in integer columns)
+TAG_NULL, TAG_INT, TAG_STRING = 0, 1, 2
+
+STRING_FIELDS = ['fclass', 'fcode', 'country', 'cc2', 'admin1', 'admin2',
+                 'admin3', 'admin4', 'continent']
+
+SNAPSHOT_RECORDS = """
+SELECT DISTINCT geonameid, official_name, altnames, latitude, longitude,
+       fclass, fcode, country, cc2, admin1, admin2, admin3, admin4,
+       continent, elevation, population, cat_type, cat_geo, cat_prom
+  FROM name_lookup
+ ORDER BY geonameid
+""".strip()
+
+SNAPSHOT_NAMES = """
+SELECT n.name, n.geonameid, h.histogram
+  FROM name_lookup n
+  LEFT JOIN name_histogram h ON (n.name = h.name)
+ ORDER BY n.name, n.geonameid
+""".strip()
+
+SNAPSHOT_CONTAINERS = [
+    (1, "SELECT iso2, name FROM country"),
+    (2, "SELECT country, admin1, name FROM admin1"),
+    (3, "SELECT country, admin1, admin2, name FROM admin2"),
+    (4, "SELECT country, admin1, admin2, admin3, name FROM geoname "
+        "WHERE fcode = 'ADM3'"),
+    (5, "SELECT country, admin1, admin2, admin3, admin4, name FROM geoname "
+        "WHERE fcode = 'ADM4'"),
+]
+
+SNAPSHOT_META = """
+SELECT value FROM meta WHERE key = ?
+""".strip()
+
+SNAPSHOT_TYPES = """
+SELECT fclass, fcode, name, description from featurecodes
+""".strip()
+
+SNAPSHOT_HAS_TYPE_TEXT = """
+SELECT count(*) FROM sqlite_master WHERE type = 'table' and name = 'type_text'
+""".strip()
+
+SNAPSHOT_TYPE_TEXT = """
+SELECT code, type, plural, description FROM type_text ORDER BY code
+""".strip()
+
+
+def to_bytes(s):
+    return s.encode('utf8') if isinstance(s, unicode) else str(s)
+
+
+def container_key(level, params):
+    return '\t'.join([str(level)] + [to_bytes(p) for p in params])
+
+
+class StringTable(object):
+    """Accumulates the string section while the snapshot is written"""
+    def __init__(self):
+        self.blob = tempfile.TemporaryFile()
+        self.index = array('I', [0])
+        self.interned = {}
+
+    def add(self, s):
+        if s is None:
+            return NO_STRING
+        b = to_bytes(s)
+        self.blob.write(b)
+        self.index.append(self.index[-1] + len(b))
+        return len(self.index) - 2
+
+    def intern(self, s):
+        if s not in self.interned:
+            self.interned[s] = self.add(s)
+        return self.interned[s]
+
+
+def encode_value(strings, v):
+    if v is None:
+        return TAG_NULL, 0
+    elif isinstance(v, (int, long)):
+        return TAG_INT, v
+    else:
+        return TAG_STRING, strings.intern(v)
+
+
+def write_snapshot(conn, filename):
+    """Writes a snapshot of the gazetteer database open on conn"""
+    strings = StringTable()
+    offsets = {}
+
+    with open(filename, 'wb') as f:
+        f.write('\0' * HEADER.size)
+
+        cur = conn.cursor()
+
+        offsets['records'] = (f.tell(), 0)
+        geonameids = array('i')
+        cur.execute(SNAPSHOT_RECORDS)
+        for r in cur:
+            elev_tag, elev = encode_value(strings, r[14])
+            pop_tag, pop = encode_value(strings, r[15])
+            f.write(RECORD.pack(
+                r[0], strings.add(r[1]), r[2] or 0, r[3], r[4],
+                *([strings.intern(v) for v in r[5:14]] +
+                  [elev_tag, elev, pop_tag, pop] +
+                  [strings.intern(v) for v in r[16:19]])))
+            geonameids.append(r[0])
+        offsets['records'] = (offsets['records'][0], len(geonameids))
+
+        # postings are collected in memory (4 bytes each) and written after
+        # the fixed-width name entries
+        postings = array('I')
+        names_off = f.tell()
+        n_names = 0
+        last_name = None
+        cur.execute(SNAPSHOT_NAMES)
+        for name, geonameid, histogram in cur:
+            name_b = to_bytes(name)
+            if name_b != last_name:
+                if last_name is not None:
+                    if name_b < last_name:
+                        raise ValueError('name_lookup is not sorted by name')
+                    f.write(NAME.pack(name_sid, first, len(postings) - first,
+                                      hist_sid))
+                    n_names += 1
+                name_sid = strings.add(name)
+                hist_sid = strings.add(histogram)
+                first = len(postings)
+                last_name = name_b
+            postings.append(bisect.bisect_left(geonameids, geonameid))
+        if last_name is not None:
+            f.write(NAME.pack(name_sid, first, len(postings) - first,
+                              hist_sid))
+            n_names += 1
+        offsets['names'] = (names_off, n_names)
+
+        offsets['postings'] = (f.tell(), len(postings))
+        postings.tofile(f)
+        del postings, geonameids
+
+        containers = {}
+        for level, sql in SNAPSHOT_CONTAINERS:
+            cur.execute(sql)
+            for r in cur:
+                k = container_key(level, r[:-1])
+                if k not in containers:
+                    containers[k] = r[-1]
+        offsets['containers'] = (f.tell(), len(containers))
+        for k in sorted(containers):
+            f.write(CONTAINER.pack(strings.add(k),
+                                   strings.intern(containers[k])))
+
+        cur.execute(SNAPSHOT_TYPES)
+        types = cur.fetchall()
+        offsets['types'] = (f.tell(), len(types))
+        for t in types:
+            f.write(TYPE.pack(*[strings.intern(v) for v in t]))
+
+        type_text = []
+        cur.execute(SNAPSHOT_HAS_TYPE_TEXT)
+        if cur.fetchone()[0]:
+            cur.execute(SNAPSHOT_TYPE_TEXT)
+            type_text = cur.fetchall()
+        offsets['type_text'] = (f.tell(), len(type_text))
+        for t in type_text:
+            f.write(TYPE.pack(*[strings.intern(v) for v in t]))
+
+        cur.execute(SNAPSHOT_META, ('build_id',))
+        row = cur.fetchone()
+        build_sid = strings.add(row[0] if row else None)
+
+        offsets['str_index'] = (f.tell(), len(strings.index))
+        strings.index.tofile(f)
+
+        offsets['str_blob'] = (f.tell(), strings.index[-1])
+        strings.blob.seek(0)
+        shutil.copyfileobj(strings.blob, f)
+        strings.blob.close()
+
+        cur.execute(SNAPSHOT_META, ('taxonomy_version',))
+        taxonomy_version = int(cur.fetchone()[0])
+
+        header = [MAGIC, FORMAT_VERSION, taxonomy_version, build_sid]
+        for s in SECTIONS:
+            header.extend(offsets[s])
+        f.seek(0)
+        f.write(HEADER.pack(*header))
+
+
+class snapshotGaz(geowhiz.Gazetteer):
+    def __init__(self, snapshot_filename):
+        self.snapshot_filename = snapshot_filename
+        with open(snapshot_filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = HEADER.unpack_from(self.mm, 0)
+        if header[0] != MAGIC or header[1] != FORMAT_VERSION:
+            raise ValueError('%s is not a version %d gazetteer snapshot' %
+                             (snapshot_filename, FORMAT_VERSION))
+        self.sections = dict(zip(SECTIONS, zip(header[4::2], header[5::2])))
+        self.taxonomy_version = header[2] or None
+        self.precomputed_categories = precomputed_categories_ok(
+            self.taxonomy_version, geowhiz.TAXONOMY_VERSION,
+            snapshot_filename)
+
+        self._str_index = self.sections['str_index'][0]
+        self._str_blob = self.sections['str_blob'][0]
+        self.build_id = self._string(header[3])
+
+    def fingerprint(self):
+        return self.build_id
+
+    def _string_bytes(self, sid):
+        off = self._str_index + sid * UINT.size
+        start, end = struct.unpack_from('<II', self.mm, off)
+        return self.mm[self._str_blob + start:self._str_blob + end]
+
+    def _string(self, sid):
+        if sid == NO_STRING:
+            return None
+        return self._string_bytes(sid).decode('utf8')
+
+    def _value(self, tag, v):
+        if tag == TAG_INT:
+            return v
+        elif tag == TAG_STRING:
+            return self._string(v)
+        return None
+
+    def _lower_bound(self, section, entry, key):
+        """Index of the first of the (string id, ...) entries of a sorted
+        section whose key is not less than key"""
+        off, count = self.sections[section]
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            e = entry.unpack_from(self.mm, off + mid * entry.size)
+            if self._string_bytes(e[0]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _search(self, section, entry, key):
+        """Binary search for key among the (string id, ...) entries of a
+        sorted section.  Returns the unpacked entry, or None."""
+        off, count = self.sections[section]
+        i = self._lower_bound(section, entry, key)
+        if i < count:
+            e = entry.unpack_from(self.mm, off + i * entry.size)
+            if self._string_bytes(e[0]) == key:
+                return e
+        return None
+
+    def _record(self, idx, name):
+        off = self.sections['records'][0] + idx * RECORD.size
+        r = RECORD.unpack_from(self.mm, off)
+        d = {'name': name,
+             'geonameid': r[0],
+             'official_name': self._string(r[1]),
+             'altnames': r[2],
+             'latitude': r[3],
+             'longitude': r[4],
+             'elevation': self._value(r[14], r[15]),
+             'population': self._value(r[16], r[17])}
+        for field, sid in zip(STRING_FIELDS, r[5:14]):
+            d[field] = self._string(sid)
+        if self.precomputed_categories:
+            d['cat'] = [self._string(sid) for sid in r[18:21]]
+        return d
+
+    def get_geoname_info(self, strings):
+        postings_off = self.sections['postings'][0]
+        res = []
+        for key in sorted(set(to_bytes(s) for s in strings)):
+            e = self._search('names', NAME, key)
+            if e is None:
+                continue
+            name = key.decode('utf8')
+            _, first, count, _ = e
+            idxs = struct.unpack_from('<%dI' % count, self.mm,
+                                      postings_off + first * UINT.size)
+            res.extend(self._record(i, name) for i in idxs)
+        return res
+
+    def get_category_histograms(self, strings):
+        if not self.precomputed_categories:
+            return {}
+        res = {}
+        for key in set(to_bytes(s) for s in strings):
+            e = self._search('names', NAME, key)
+            if e is not None and e[3] != NO_STRING:
+                res[key.decode('utf8')] = decode_histogram(
+                    self._string_bytes(e[3]))
+        return res
+
+    def get_types(self):
+        off, count = self.sections['types']
+        return [tuple(self._string(sid)
+                      for sid in TYPE.unpack_from(self.mm,
+                                                  off + i * TYPE.size))
+                for i in range(count)]
+
+    def get_type_text(self):
+        off, count = self.sections['type_text']
+        if not count:
+            return None
+        type_text = {}
+        for i in range(count):
+            code, t, plural, desc = [
+                self._string(sid)
+                for sid in TYPE.unpack_from(self.mm, off + i * TYPE.size)]
+            type_text[code] = {'type': t, 'plural': plural, 'desc': desc}
+        return type_text
+
+    def _get_container(self, level, params):
+        e = self._search('containers', CONTAINER,
+                         container_key(level, params))
+        if e is None:
+            return None
+        return (self._string(e[1]),)
+
+    def get_container_names(self, level, keys=None):
+        if keys is not None:
+            names = {}
+            for k in keys:
+                res = self._get_container(level, k)
+                if res and res[0]:
+                    names[k] = res[0]
+            return names
+
+        # containers of a level are contiguous, as keys start with the level
+        off, count = self.sections['containers']
+        prefix = container_key(level, []) + '\t'
+        names = {}
+        for i in xrange(self._lower_bound('containers', CONTAINER, prefix),
+                        count):
+            e = CONTAINER.unpack_from(self.mm, off + i * CONTAINER.size)
+            k = self._string_bytes(e[0])
+            if not k.startswith(prefix):
+                break
+            name = self._string(e[1])
+            if name:
+                names[tuple(p.decode('utf8')
+                            for p in k[len(prefix):].split('\t'))] = name
+        return names
+
+    def get_container_country(self, params):
+        return self._get_container(1, params)
+
+    def get_container_admin1(self, params):
+        return self._get_container(2, params)
+
+    def get_container_admin2(self, params):
+        return self._get_container(3, params)
+
+    def get_container_admin3(self, params):
+        return self._get_container(4, params)
+
+    def get_container_admin4(self, params):
+        return self._get_container(5, params)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m geowhiz.gaz.snapshot',
+        description='Write a snapshot of a SQLite gazetteer database.')
+    parser.add_argument('db_filename')
+    parser.add_argument('snapshot_filename')
+    args = parser.parse_args(argv)
+    # write to a temporary file and rename, so that processes that have the
+    # old snapshot mapped keep a consistent copy
+    tmp_filename = '%s.%d.tmp' % (args.snapshot_filename, os.getpid())
+    conn = sqlite3.connect(args.db_filename)
+    try:
+        write_snapshot(conn, tmp_filename)
+    finally:
+        conn.close()
+    os.rename(tmp_filename, args.snapshot_filename)
+
+
+if __name__ == '__main__':
+    main()
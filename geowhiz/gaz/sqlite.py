@@ -1,8 +1,32 @@
+import contextlib
 import itertools
+import os
+import Queue
 import sqlite3
+import threading
+import warnings
 import geowhiz
+from geowhiz.category import decode_histogram
+from geowhiz.gazetteer import pop_category, precomputed_categories_ok
 
 GET_GAZ_DATA = """
+SELECT name, geonameid, official_name, altnames, latitude, longitude, fclass,
+       fcode, country, cc2, admin1, admin2, admin3, admin4, elevation,
+       population, continent
+  FROM name_lookup
+ WHERE name in (%s)
+""".strip()
+
+GET_GAZ_DATA_CATEGORIES = """
+SELECT name, geonameid, official_name, altnames, latitude, longitude, fclass,
+       fcode, country, cc2, admin1, admin2, admin3, admin4, elevation,
+       population, continent, cat_type, cat_geo, cat_prom
+  FROM name_lookup
+ WHERE name in (%s)
+""".strip()
+
+# legacy query for gazetteers built before the name_lookup table was added
+GET_GAZ_DATA_UNION = """
 SELECT distinct * from (
     SELECT geonameid, name, name as official_name, altnames, latitude,
            longitude, fclass, fcode, country, cc2, admin1, admin2, admin3,
@@ -26,6 +50,27 @@ SELECT distinct * from (
  ORDER BY name
 """
 
+HAS_NAME_LOOKUP = """
+SELECT count(*) FROM sqlite_master WHERE type = 'table' and name = 'name_lookup'
+""".strip()
+
+GET_HISTOGRAMS = """
+SELECT name, histogram FROM name_histogram WHERE name in (%s)
+""".strip()
+
+HAS_HISTOGRAMS = """
+SELECT count(*) FROM sqlite_master
+ WHERE type = 'table' and name = 'name_histogram'
+""".strip()
+
+HAS_META = """
+SELECT count(*) FROM sqlite_master WHERE type = 'table' and name = 'meta'
+""".strip()
+
+GET_META = """
+SELECT value FROM meta WHERE key = ?
+""".strip()
+
 GET_CONTINENTS = """
 SELECT iso2, name, continent from country;
 """
@@ -34,6 +79,14 @@ GET_TYPES = """
 SELECT fclass, fcode, name, description from featurecodes;
 """.strip()
 
+HAS_TYPE_TEXT = """
+SELECT count(*) FROM sqlite_master WHERE type = 'table' and name = 'type_text'
+""".strip()
+
+GET_TYPE_TEXT = """
+SELECT code, type, plural, description FROM type_text
+""".strip()
+
 GET_CONTAINER_COUNTRY_NAME = """
 SELECT name FROM country WHERE iso2 = ?
 """.strip()
@@ -59,41 +112,204 @@ WHERE country = ? and admin1 = ? and admin2 = ? and admin3 = ? and admin4 = ?
 and fcode = 'ADM4'
 """
 
+# names of all containers of each level (see Gazetteer.get_container_names),
+# with the columns holding their codes
+GET_CONTAINER_NAMES = {
+    1: ("SELECT iso2, name FROM country WHERE 1", ['iso2']),
+    2: ("SELECT country, admin1, name FROM admin1 WHERE 1",
+        ['country', 'admin1']),
+    3: ("SELECT country, admin1, admin2, name FROM admin2 WHERE 1",
+        ['country', 'admin1', 'admin2']),
+    4: ("SELECT country, admin1, admin2, admin3, name FROM geoname "
+        "WHERE fcode = 'ADM3'", ['country', 'admin1', 'admin2', 'admin3']),
+    5: ("SELECT country, admin1, admin2, admin3, admin4, name FROM geoname "
+        "WHERE fcode = 'ADM4'",
+        ['country', 'admin1', 'admin2', 'admin3', 'admin4']),
+}
+
+# read-only connection settings, applied to every pooled connection
+DEFAULT_PRAGMAS = [
+    ('query_only', 1),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -16000),  # in KiB
+]
+
 # a helper function to avoid "too many SQL variables" error
 def chunks(l, n):
     for i in xrange(0, len(l), n):
         yield l[i:i+n]
 
+def padded(strings, min_size=8):
+    """Pads a parameter list with NULLs to the next power of two, so that the
+    number of distinct IN (...) statements (and prepared statements cached by
+    each connection) stays small."""
+    size = min_size
+    while size < len(strings):
+        size *= 2
+    return list(strings) + [None] * (size - len(strings))
+
+
+class ConnectionPool(object):
+    """A bounded pool of read-only SQLite connections.
+
+    A thread checks out one connection for its outermost connection() block
+    and reuses it for nested blocks.  When all connections are in use, other
+    threads wait for one to be returned.  Connections are never shared
+    across fork(): a child process discards the connections it inherits and
+    opens its own.
+    """
+    def __init__(self, db_filename, size=4, pragmas=None,
+                 cached_statements=100):
+        self.db_filename = db_filename
+        self.size = size
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self.cached_statements = cached_statements
+        self._fork_lock = threading.Lock()
+        # pools of parent processes (kept so their connections stay open)
+        self._inherited = []
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._local = threading.local()
+
+    def _check_pid(self):
+        # after a fork, drop the parent's connections (without closing them,
+        # as they are still the parent's to use)
+        if self._pid != os.getpid():
+            with self._fork_lock:
+                if self._pid != os.getpid():
+                    self._inherited.append((self._idle, self._local))
+                    self._reset()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_filename, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            conn.execute('PRAGMA %s = %s' % (name, value))
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        self._check_pid()
+        local, idle, slots = self._local, self._idle, self._slots
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        slots.acquire()
+        try:
+            try:
+                conn = idle.get_nowait()
+            except Queue.Empty:
+                conn = self._connect()
+            local.conn = conn
+            try:
+                yield conn
+            finally:
+                local.conn = None
+                idle.put(conn)
+        finally:
+            slots.release()
+
+    def close(self):
+        self._check_pid()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
 class sqliteGaz(geowhiz.Gazetteer):
-    def __init__(self, db_filename, recreate_conn=False):
+    """Gazetteer backed by a SQLite database built by update_gaz.py.  Queries
+    run on connections checked out of a ConnectionPool of pool_size
+    connections, so the db_conn attribute and the recreate_conn argument of
+    earlier versions are gone (recreate_conn is still accepted, but
+    ignored).  The pool opens new connections in each forked process, as
+    recreate_conn did, so a sqliteGaz can be created before a server forks
+    its workers."""
+    def __init__(self, db_filename, recreate_conn=None, pool_size=4,
+                 pragmas=None):
+        if recreate_conn is not None:
+            warnings.warn('recreate_conn is ignored; sqliteGaz uses a pool of '
+                          'connections (see pool_size)',
+                          DeprecationWarning, stacklevel=2)
         self.db_filename = db_filename
-        self.db_conn = sqlite3.connect(db_filename)
-        self.db_conn.row_factory = sqlite3.Row
-        self.recreate_conn = recreate_conn
+        self.pool = ConnectionPool(db_filename, size=pool_size,
+                                   pragmas=pragmas)
         self.continents = self._load_continents()
+        self.has_name_lookup = self._has_name_lookup()
+        self.taxonomy_version = self._get_meta('taxonomy_version')
+        self.build_id = self._get_meta('build_id')
+        self.precomputed_categories = (
+            self.has_name_lookup and
+            precomputed_categories_ok(
+                self.taxonomy_version, geowhiz.TAXONOMY_VERSION, db_filename)
+        )
+        self.has_histograms = (self.precomputed_categories and
+                               self._fetchone(HAS_HISTOGRAMS)[0] > 0)
 
-    def _get_conn(self):
-        if self.recreate_conn:
-            db_conn = sqlite3.connect(self.db_filename)
-            db_conn.row_factory = sqlite3.Row
-            return db_conn
-        else:
-            return self.db_conn
+    def _fetchall(self, sql, params=()):
+        with self.pool.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _fetchone(self, sql, params=()):
+        with self.pool.connection() as conn:
+            return conn.execute(sql, params).fetchone()
 
     def _load_continents(self):
-        cur = self._get_conn().cursor()
-        cur.execute(GET_CONTINENTS)
-        return dict((r[0], r[2]) for r in cur.fetchall())
+        return dict((r[0], r[2]) for r in self._fetchall(GET_CONTINENTS))
+
+    def _has_name_lookup(self):
+        return self._fetchone(HAS_NAME_LOOKUP)[0] > 0
+
+    def _get_meta(self, key):
+        if self._fetchone(HAS_META)[0] == 0:
+            return None
+        row = self._fetchone(GET_META, (key,))
+        return row[0] if row else None
+
+    def fingerprint(self):
+        return self.build_id
 
     def get_geoname_info(self, strings):
-        cur = self._get_conn().cursor()
-        param_sub = ', '.join('?' for i in strings)
+        if not self.has_name_lookup:
+            return self._get_geoname_info_union(strings)
+        if len(strings) > 512:
+            return itertools.chain(*(self.get_geoname_info(s) for s in chunks(strings, 512)))
+        params = padded(strings)
+        param_sub = ', '.join('?' for i in params)
+        if self.precomputed_categories:
+            rows = self._fetchall(GET_GAZ_DATA_CATEGORIES % (param_sub,),
+                                  params)
+            return list(pop_category(dict(r)) for r in rows)
+        rows = self._fetchall(GET_GAZ_DATA % (param_sub,), params)
+        return list(dict(r) for r in rows)
+
+    def get_category_histograms(self, strings):
+        if not self.has_histograms:
+            return {}
+        res = {}
+        for chunk in chunks(strings, 512):
+            params = padded(chunk)
+            param_sub = ', '.join('?' for i in params)
+            for name, blob in self._fetchall(GET_HISTOGRAMS % (param_sub,),
+                                             params):
+                res[name] = decode_histogram(str(blob))
+        return res
+
+    def _get_geoname_info_union(self, strings):
         if len(strings) > 320:
-            return itertools.chain(*(self.get_geoname_info(s) for s in chunks(strings, 320)))
-        get_gaz_data = GET_GAZ_DATA % (param_sub, param_sub, param_sub)
-        cur.execute(get_gaz_data, strings * 3)
+            return itertools.chain(*(self._get_geoname_info_union(s) for s in chunks(strings, 320)))
+        param_sub = ', '.join('?' for i in strings)
+        get_gaz_data = GET_GAZ_DATA_UNION % (param_sub, param_sub, param_sub)
 
-        res = list(dict(r) for r in cur.fetchall())
+        res = list(dict(r) for r in self._fetchall(get_gaz_data, strings * 3))
         for r in res:
             r['altnames'] = r['altnames'].count(',')
             r['continent'] = self.continents.get(r['country'])
@@ -101,31 +317,54 @@ class sqliteGaz(geowhiz.Gazetteer):
         return res
 
     def get_types(self):
-        cur = self._get_conn().cursor()
-        cur.execute(GET_TYPES)
-        return cur.fetchall()
+        return self._fetchall(GET_TYPES)
+
+    def get_type_text(self):
+        if not self._fetchone(HAS_TYPE_TEXT)[0]:
+            return None
+        return dict((code, {'type': t, 'plural': plural, 'desc': desc})
+                    for code, t, plural, desc in self._fetchall(GET_TYPE_TEXT))
 
     def get_container_country(self, params):
-        cur = self._get_conn().cursor()
-        cur.execute(GET_CONTAINER_COUNTRY_NAME, params)
-        return cur.fetchone()
+        return self._fetchone(GET_CONTAINER_COUNTRY_NAME, params)
 
     def get_container_admin1(self, params):
-        cur = self._get_conn().cursor()
-        cur.execute(GET_CONTAINER_ADMIN1_NAME, params)
-        return cur.fetchone()
+        return self._fetchone(GET_CONTAINER_ADMIN1_NAME, params)
 
     def get_container_admin2(self, params):
-        cur = self._get_conn().cursor()
-        cur.execute(GET_CONTAINER_ADMIN2_NAME, params)
-        return cur.fetchone()
+        return self._fetchone(GET_CONTAINER_ADMIN2_NAME, params)
 
     def get_container_admin3(self, params):
-        cur = self._get_conn().cursor()
-        cur.execute(GET_CONTAINER_ADMIN3_NAME, params)
-        return cur.fetchone()
+        return self._fetchone(GET_CONTAINER_ADMIN3_NAME, params)
 
     def get_container_admin4(self, params):
-        cur = self._get_conn().cursor()
-        cur.execute(GET_CONTAINER_ADMIN4_NAME, params)
-        return cur.fetchone()
+        return self._fetchone(GET_CONTAINER_ADMIN4_NAME, params)
+
+    def get_container_names(self, level, keys=None):
+        sql, columns = GET_CONTAINER_NAMES[level]
+        if keys is None:
+            return self._container_names(self._fetchall(sql))
+
+        # narrow by the first and last code of each key, then keep only the
+        # requested keys
+        keys = set(keys)
+        names = {}
+        for chunk in chunks(sorted(keys), 256):
+            firsts = padded(set(k[0] for k in chunk))
+            lasts = padded(set(k[-1] for k in chunk))
+            query = '%s AND %s IN (%s) AND %s IN (%s)' % (
+                sql, columns[0], ', '.join('?' for i in firsts),
+                columns[-1], ', '.join('?' for i in lasts))
+            for k, name in self._container_names(
+                    self._fetchall(query, firsts + lasts)).iteritems():
+                if k in keys:
+                    names[k] = name
+        return names
+
+    def _container_names(self, rows):
+        names = {}
+        for r in rows:
+            r = tuple(r)
+            if r[-1] and r[:-1] not in names:
+                names[r[:-1]] = r[-1]
+        return names
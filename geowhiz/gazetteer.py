@@ -1,8 +1,41 @@
+import sys
+
+from category import LATTICE
+
+
 class Gazetteer(object):
     """Abstract base class for fetching GeoNames data"""
+
+    # taxonomy version of the category strings returned with each geoname
+    # (as geoname['cat']), or None if categories are not precomputed
+    taxonomy_version = None
+
     def get_geoname_info(self, strings):
         pass
 
+    def get_category_histograms(self, strings):
+        """Returns histograms (see category.histogram) of the categories of
+        the interpretations of each string, for strings that have one
+        precomputed.  Histograms are keyed by category.LATTICE node ids."""
+        return {}
+
+    def fingerprint(self):
+        """Returns a string identifying the gazetteer data (it must change
+        whenever the data does), or None if the data cannot be identified.
+        Used to tell whether a saved classifier model is stale."""
+        return None
+
+    def get_types(self):
+        """Returns the (fclass, fcode, name, description) rows of the
+        GeoNames feature codes"""
+        return []
+
+    def get_type_text(self):
+        """Returns the text ({'type', 'plural', 'desc'}) of each type
+        category string, as stored by update_gaz.py, or None if it was not
+        stored (see cattext.build_type_text)"""
+        return None
+
     def get_country_name(self, country_code):
         pass
 
@@ -12,10 +45,53 @@ class Gazetteer(object):
     def get_admin2_name(self, country_code, admin1, admin2):
         pass
 
+    def get_container_names(self, level, keys=None):
+        """Returns the names of containers (countries for level 1, and admin1
+        to admin4 regions for levels 2 to 5) as a dict keyed by tuples of
+        their codes (e.g. ('US', 'VA') at level 2).  Only the containers in
+        keys are returned, or all of them if keys is None and the gazetteer
+        can list them.  Gazetteers should override this to fetch many names
+        at once; by default, country, admin1 and admin2 names are fetched one
+        at a time with get_country_name, get_admin1_name and
+        get_admin2_name."""
+        names = {}
+        f = {1: self.get_country_name,
+             2: self.get_admin1_name,
+             3: self.get_admin2_name}.get(level)
+        if keys is None or f is None:
+            return names
+        for k in keys:
+            name = f(*k)
+            if name:
+                names[k] = name
+        return names
+
     def lookup(self, strings, categorize_func):
         return Lookup(strings, self, categorize_func)
 
 
+def precomputed_categories_ok(stored_version, current_version, source):
+    """Returns True iff categories stored with a gazetteer were computed with
+    the current taxonomy.  Warns when they are stale."""
+    if stored_version is None:
+        return False
+    if int(stored_version) != int(current_version):
+        print >> sys.stderr, (
+            '%s has categories for taxonomy version %s (current version is '
+            '%s); computing categories at runtime instead' %
+            (source, stored_version, current_version))
+        return False
+    return True
+
+
+def pop_category(row):
+    """Moves the precomputed category columns of a gazetteer row into a
+    single 'cat' list (matching the output of Lookup.get_category)"""
+    row['cat'] = [row.pop('cat_type'), row.pop('cat_geo'),
+                  row.pop('cat_prom')]
+    return row
+
+
 def remove_unlikely_strings(strings):
     return [
         s for s in strings
@@ -38,17 +114,24 @@ class Lookup(object):
     specified strings"""
     def __init__(self, strings, gaz, categorize_func):
         self.strings = []
+        # strings already queried (add_strings may be called repeatedly)
+        self.queried = set()
         self.geoname_lookup = {}
         self.geoname_id_lookup = {}
         self.gaz = gaz
         self.categorize_func = categorize_func
+        self.histograms = {}
         self.add_strings(strings)
         self.type_lookup = {}
         self._category_cache = {}
 
     def add_strings(self, strings):
         unique_strings = remove_unlikely_strings(set(strings))
-        unique_strings = set(add_comma_strings(unique_strings))
+        unique_strings = set(add_comma_strings(unique_strings)) - self.queried
+        if not unique_strings:
+            # (some gazetteers cannot query an empty list of names)
+            return
+        self.queried.update(unique_strings)
         geoname_results = self.gaz.get_geoname_info(list(unique_strings))
 
         for geoname in geoname_results:
@@ -64,6 +147,10 @@ class Lookup(object):
             self.geoname_lookup[g_dict['name']].append(g_dict)
             self.geoname_id_lookup[g_dict['geonameid']] = g_dict
 
+        self.histograms.update(
+            self.gaz.get_category_histograms(list(unique_strings))
+        )
+
         for s in unique_strings:
             if (',' not in s) or (s in self.geoname_lookup):
                 continue
@@ -120,6 +207,12 @@ class Lookup(object):
     def get_by_name(self, name):
         return self.geoname_lookup.get(name, [])
 
+    def get_histogram(self, name):
+        return self.histograms.get(name)
+
+    def set_histogram(self, name, histogram):
+        self.histograms[name] = histogram
+
     def get_by_id(self, id_val):
         return self.geoname_id_lookup.get(id_val, None)
 
@@ -130,6 +223,10 @@ class Lookup(object):
         if geonameid in self._category_cache:
             return self._category_cache[geonameid]
         else:
-            cat = self.categorize_func(geoname)
+            # use category computed at gazetteer build time, if available
+            if geoname.get('cat'):
+                cat = LATTICE.from_s(geoname['cat'])
+            else:
+                cat = self.categorize_func(geoname)
             self._category_cache[geonameid] = cat
             return cat
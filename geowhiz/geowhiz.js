@@ -104,11 +104,17 @@ function isHighlighted(pt) {
 
 /* GeoWhiz UI */
 var data_obj;
+var data_txt;
+// lets the server geotag edits to the list incrementally
+var session_id = Math.random().toString(36).slice(2);
 var markers = {};
 var cat_data = {};
 d3.select('#submit').on('click', function() {
   var txt = d3.select('#vals').property('value');
-  d3.json('./geotag?vals=' + encodeURIComponent(txt), function(error, json) {
+  d3.json('./geotag?vals=' + encodeURIComponent(txt) +
+          '&session=' + session_id + '&max_resolved=1',
+          function(error, json) {
+    data_txt = txt;
     reveal('#results-container');
     d3.select('#results').style('display', 'table').selectAll('tr.cat').remove();
     data_obj = json;
@@ -165,13 +171,34 @@ d3.select('#submit').on('click', function() {
         .style('opacity', function(d) {return c(d).opacity * 2;});
 
       cat_data = d;
-      showTrees(cat_data);
-      updatePts(cat_data);
+      withInterpretations(d, function() {
+        showTrees(cat_data);
+        updatePts(cat_data);
+      });
     });
   });
   d3.event.preventDefault();
 });
 
+// only the top assignment's interpretations are included in the results;
+// fetch those of other assignments when they are selected
+function withInterpretations(assignment, callback) {
+  if (assignment.cell_interpretations) {return callback();}
+  var cats = assignment.categories.map(function(c) {return c.category;});
+  d3.json('./geotag?vals=' + encodeURIComponent(data_txt) +
+          '&session=' + session_id +
+          '&assignment=' + encodeURIComponent(JSON.stringify(cats)),
+          function(error, json) {
+    if (error || !json.assignments.length) {return;}
+    assignment.cell_interpretations = json.assignments[0].cell_interpretations;
+    for (var node in json.cat_node_text) {
+      data_obj.cat_node_text[node] = json.cat_node_text[node];
+    }
+    // skip if another assignment was selected in the meantime
+    if (cat_data === assignment) {callback();}
+  });
+}
+
 function updatePts() {
   var pts = cat_data.cell_interpretations[0],
       seen = {};
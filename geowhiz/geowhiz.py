@@ -1,10 +1,15 @@
 import os
 import math
 import json
+import types
+import hashlib
+import itertools
+import threading
 
 import taxonomy
 import classifier
 import cattext
+from category import LATTICE
 
 ###################################################################
 # functions to extract dimension values from raw gazetteer result #
@@ -55,18 +60,28 @@ def prominence_classifier(d):
     return prominence_tree[:prom + 1]
 
 
+def build_taxonomy():
+    t = taxonomy.Taxonomy()
+    t.add_dimension(taxonomy.Dimension(type_classifier))
+    t.add_dimension(taxonomy.Dimension(geo_classifier))
+    t.add_dimension(taxonomy.Dimension(prominence_classifier))
+    return t
+
+
 #############################################
 # feature functions for Bayesian classifier #
 #############################################
 
 
-depth = lambda x: x.count('|')
+# categories are tuples of category.LATTICE node ids
+depth = lambda x: LATTICE.depths[x]
+node_s = lambda x: LATTICE.strings[x]
 amb_log = lambda x: math.floor(math.log(x) / math.log(1.1))
 
 
 feature_funcs = [
     lambda x, y: 'COV',  # dummy feature to test coverage probability
-    lambda x, y: x[0],
+    lambda x, y: node_s(x[0]),
     #lambda x, y: taxonomy.get_depths(x),
     lambda x, y: depth(x[2]),
     lambda x, y: depth(x[1]),
@@ -77,20 +92,80 @@ feature_funcs = [
     lambda x, y: 1.00001 <= y['ambiguity'] < 1.3,
     lambda x, y: 1.3 <= y['ambiguity'] < 1.75,
     lambda x, y: 1.75 <= y['ambiguity'],
-    lambda x, y: (x[0].startswith(TYPE_ROOT+'|P'), depth(x[2])),
+    lambda x, y: (node_s(x[0]).startswith(TYPE_ROOT+'|P'), depth(x[2])),
 ]
 
 
+def _code_fingerprint(code, h):
+    h.update(code.co_code)
+    h.update(repr(code.co_names))
+    for c in code.co_consts:
+        # nested functions (repr would include their address)
+        if isinstance(c, types.CodeType):
+            _code_fingerprint(c, h)
+        else:
+            h.update(repr(c))
+
+
+def code_fingerprint(funcs):
+    """Hash of the code of functions (e.g. the feature functions), and of the
+    module-level helper functions and constants that they refer to"""
+    h = hashlib.sha1()
+    seen = set()
+
+    def add(f):
+        if f in seen:
+            return
+        seen.add(f)
+        _code_fingerprint(f.func_code, h)
+        for name in f.func_code.co_names:
+            v = f.func_globals.get(name)
+            if isinstance(v, types.FunctionType):
+                add(v)
+            elif isinstance(v, (basestring, int, long, float, list, tuple)):
+                h.update('%s=%r' % (name, v))
+
+    for f in funcs:
+        add(f)
+    return h.hexdigest()
+
+
+def taxonomy_fingerprint():
+    """Hash of the code that categorizes geonames: build_taxonomy, the
+    dimension functions it uses, and the Taxonomy and Dimension classes"""
+    funcs = [build_taxonomy]
+    for cls in (taxonomy.Taxonomy, taxonomy.Dimension):
+        funcs.extend(f for name, f in sorted(vars(cls).items())
+                     if isinstance(f, types.FunctionType))
+    return code_fingerprint(funcs)
+
+
+# version of the taxonomy.  Gazetteers may store categories computed at build
+# time (see update_gaz.py), along with this version, so that stale
+# precomputed categories are detected and ignored.  It is derived from the
+# code of the taxonomy, so it changes with any edit to it (or a change of
+# Python version) and never needs to be bumped by hand.  (a positive 28-bit
+# integer, to fit the snapshot header.)
+TAXONOMY_VERSION = int(taxonomy_fingerprint()[:7], 16) or 1
+
+
 ###############################################
 # prepare classifier using training data file #
 ###############################################
 
 
+TRAINING_SET_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 'train.txt')
+
+
+def training_set_fingerprint():
+    with open(TRAINING_SET_FILE, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
 def load_training_set():
-    cur_dir = os.path.dirname(os.path.realpath(__file__))
-    train_file = os.path.join(cur_dir, 'train.txt')
     training_set = []
-    with open(train_file) as f:
+    with open(TRAINING_SET_FILE) as f:
         lines = list(f)
         pairs = zip(lines[::3], lines[1::3])
         for toponyms_line, cat_line in pairs:
@@ -105,9 +180,45 @@ def load_training_set():
 ##################################
 
 
+def as_row(row):
+    # a string is a row with a single cell
+    if isinstance(row, basestring):
+        return [row]
+    return row
+
+
+def as_grid(grid):
+    # a list of strings is a single column
+    if grid and isinstance(grid[0], basestring):
+        return [grid]
+    return grid
+
+
+def shape_interpretations(interpretations, likely=False, fields=None,
+                          compact=False):
+    """Selects interpretations of a column for a response: only those chosen
+    by either resolution method if likely, and only the given fields (all,
+    if None).  If compact, returns a dict of the list of values of each
+    field (None where missing) rather than a list of dicts."""
+    if likely:
+        interpretations = [i for i in interpretations
+                           if i.get('likely') or i.get('prox_likely')]
+    if compact:
+        if fields is None:
+            fields = sorted(set(k for i in interpretations for k in i))
+        return dict((f, [i.get(f) for i in interpretations]) for f in fields)
+    if fields is None:
+        return interpretations
+    return [dict((f, i[f]) for f in fields if f in i)
+            for i in interpretations]
+
+
 class GeoWhiz(object):
-    def __init__(self, gaz):
+    def __init__(self, gaz, model_file=None):
+        # the trained classifier is saved to (and loaded from) model_file, if
+        # given, so that it is only retrained when it is stale
         self.gaz = gaz
+        self.model_file = model_file
         self.taxonomy = self._initialize_taxonomy()
         self.classifier = self._initialize_classifier()
 
@@ -115,18 +226,31 @@ class GeoWhiz(object):
         self.cat_text = cattext.CatText(self.gaz)
 
     def _initialize_taxonomy(self):
-        t = taxonomy.Taxonomy()
-        t.add_dimension(taxonomy.Dimension(type_classifier))
-        t.add_dimension(taxonomy.Dimension(geo_classifier))
-        t.add_dimension(taxonomy.Dimension(prominence_classifier))
-        return t
+        return build_taxonomy()
 
     def _initialize_classifier(self):
         c = classifier.BayesClassifier(self.gaz, self.taxonomy)
         c.set_feature_funcs(feature_funcs)
+
+        fingerprint = self.model_file and self.model_fingerprint()
+        if fingerprint and c.load_model(self.model_file, fingerprint):
+            return c
         c.train(load_training_set())
+        if fingerprint:
+            c.save_model(self.model_file, fingerprint)
         return c
 
+    def model_fingerprint(self):
+        """Identifies everything the trained classifier depends on, or None
+        if the gazetteer cannot be identified (so a model cannot be reused)"""
+        gaz_fingerprint = self.gaz.fingerprint()
+        if gaz_fingerprint is None:
+            return None
+        return {'feature_funcs': code_fingerprint(feature_funcs),
+                'taxonomy_version': TAXONOMY_VERSION,
+                'gazetteer': gaz_fingerprint,
+                'training_set': training_set_fingerprint()}
+
     def geotag(self, grid, **options):
         results = self.classifier.geotag(grid, **options)
         return Assignment(**results)
@@ -134,10 +258,108 @@ class GeoWhiz(object):
     def geotag_full(self,
                     grid,
                     resolution_method=None,
-                    include_text=False):
+                    include_text=False,
+                    max_resolved=None,
+                    assignment=None,
+                    top=20,
+                    sample_size=None,
+                    sample_tolerance=classifier.SAMPLE_TOLERANCE):
+        """Geotags the grid, returning the top most likely category
+        assignments.
+
+        Interpretations are only resolved up front for the first max_resolved
+        assignments (all, if None); the others are resolved when their
+        cell_interpretations are first accessed.  If assignment (a list of
+        category string lists, one per column) is given, only the matching
+        assignment is returned.
+
+        If sample_size is given, the categories of each column are chosen
+        from a random sample of (at least) sample_size cells, grown until the
+        result is stable within sample_tolerance; interpretations are still
+        resolved for every cell.  Each category then includes 'sample', with
+        the sample size and estimated error (see
+        ColumnClassifier._classify_sampled_column)."""
+        return self._geotag_full(grid, None, resolution_method, include_text,
+                                 max_resolved, assignment, top,
+                                 sample_size, sample_tolerance)
+
+    def geotag_many(self,
+                    grids,
+                    resolution_method=None,
+                    include_text=False,
+                    max_resolved=None,
+                    top=20,
+                    batch_size=1000,
+                    sample_size=None,
+                    sample_tolerance=classifier.SAMPLE_TOLERANCE):
+        """Geotags each of an iterable of grids, yielding results (as
+        geotag_full) in order.
+
+        The grids are read in batches of batch_size.  The distinct strings of
+        all grids in a batch are fetched from the gazetteer at once, and each
+        geoname is categorized once per batch."""
+        grids = iter(grids)
+        while True:
+            batch = [as_grid(g) for g in itertools.islice(grids, batch_size)]
+            if not batch:
+                return
+            geonames = self.classifier.lookup(
+                [s for grid in batch for col in grid for s in col])
+            for grid in batch:
+                yield self._geotag_full(grid, geonames, resolution_method,
+                                        include_text, max_resolved, None, top,
+                                        sample_size, sample_tolerance)
+
+    def geotag_stream(self,
+                      rows,
+                      resolution_method=None,
+                      include_text=False,
+                      chunk_size=10000):
+        """Geotags a single (possibly very long) column, given as an iterable
+        of strings.  Memory use is bounded by the number of distinct values,
+        rather than rows (see ColumnClassifier.geotag_stream).
+
+        Returns StreamGeotagResults with the most likely category assignment
+        and interpretations(value), the interpretations of a value.
+        chunks(rows) reads the rows again, yielding lists of the
+        interpretations of chunk_size rows at a time, in row order; if the
+        rows can be iterated again (e.g., a list), iterating over the results
+        does the same."""
+        results = self.classifier.geotag_stream(
+            rows, resolution_method=resolution_method, chunk_size=chunk_size)
+        assignment = Assignment(results['categories'], results['likelihood'])
+        if include_text:
+            self.include_text([assignment])
+        return StreamGeotagResults(assignment, results['rows'],
+                                   results['interpretations'],
+                                   results['chunks'])
+
+    def session(self, resolution_method=None, include_text=False):
+        """Returns a GeotagSession, for geotagging a grid (e.g., a list being
+        edited) whose rows change between calls"""
+        return GeotagSession(self, resolution_method, include_text)
+
+    def _geotag_full(self, grid, geonames, resolution_method, include_text,
+                     max_resolved, assignment, top, sample_size,
+                     sample_tolerance):
+        if assignment is not None:
+            max_resolved = 0
         results = self.classifier.geotag_full(grid,
-                                              resolution_method=resolution_method)
+                                              resolution_method=resolution_method,
+                                              max_resolved=max_resolved,
+                                              top=top,
+                                              geonames=geonames,
+                                              sample_size=sample_size,
+                                              sample_tolerance=sample_tolerance)
+        return self._full_results(results, include_text, assignment)
+
+    def _full_results(self, results, include_text, assignment):
         assignments = [Assignment(**r) for r in results]
+        if assignment is not None:
+            assignments = [a for a in assignments
+                           if a.category_strings() == assignment]
+            for a in assignments:
+                a.resolve()
 
         cat_node_text = None
         if include_text:
@@ -148,6 +370,8 @@ class GeoWhiz(object):
 
     def include_text(self, assignments):
         # attach text description for each category (used for web interfact)
+        self.cat_text.prefetch(col['category'][1] for r in assignments
+                               for col in r.categories)
         for r in assignments:
             for col in r.categories:
                 col['txt'] = self.cat_text.cat_text(col['category'],
@@ -156,24 +380,30 @@ class GeoWhiz(object):
     def cat_node_text(self, assignments):
         # accumulate category nodes, return text description for each (to
         # display on nodes in tree visualization)
-        cat_node_text = {}
+        cats = set()
         for r in assignments:
+            if not r.resolved:
+                continue
             for col in r.cell_interpretations:
                 for interp in col:
-                    cat = interp['cat']
-                    for i in range(len(cat)):
-                        node_l = cat[i].split('|')
-                        # include parent nodes
-                        for j in range(len(node_l)):
-                            node = '|'.join(node_l[:j+1])
-                            if node not in cat_node_text:
-                                cat_node_text[node] = self.cat_text.cat_node_text(node, i)
+                    cats.update(enumerate(interp['cat']))
+        self.cat_text.prefetch(cat_s for i, cat_s in cats if i == 1)
+
+        cat_node_text = {}
+        for i, cat_s in cats:
+            node_l = cat_s.split('|')
+            # include parent nodes
+            for j in range(len(node_l)):
+                node = '|'.join(node_l[:j+1])
+                if node not in cat_node_text:
+                    cat_node_text[node] = self.cat_text.cat_node_text(node, i)
         return cat_node_text
 
 
-    def web_app(self):
+    def web_app(self, **options):
+        # (options are those of web.create_app)
         import web
-        return web.create_app(self)
+        return web.create_app(self, **options)
 
     def cat_text(self, category, number):
         return self.cat_text_func(category, number)
@@ -187,13 +417,182 @@ class FullGeotagResults(object):
         self.assignments = assignments
         self.cat_node_text = cat_node_text
 
-    def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True)
+    def to_dict(self, assignments=None, interpretations='all', fields=None,
+                compact=False):
+        """Returns the parts of the results requested for a response: the
+        first assignments (all, if None), with all or only the 'likely'
+        interpretations, and only the given interpretation fields (see
+        shape_interpretations).  cat_node_text is left out if fields does
+        not include 'cat'."""
+        if interpretations not in ('all', 'likely'):
+            raise ValueError('interpretations must be "all" or "likely"')
+        d = {'assignments': [
+            a.to_dict(interpretations == 'likely', fields, compact)
+            for a in self.assignments[:assignments]]}
+        if fields is None or 'cat' in fields:
+            d['cat_node_text'] = self.cat_node_text
+        return d
+
+    def toJSON(self, **options):
+        # options are those of to_dict.  unresolved assignments are
+        # serialized with null cell_interpretations
+        return json.dumps(self.to_dict(**options), sort_keys=True)
+
+    def iter_ndjson(self, max_resolved=None, chunk_size=1000,
+                    cat_node_text=None, assignments=None,
+                    interpretations='all', fields=None, compact=False):
+        """Yields the results as lines of JSON, so that they can be sent
+        before every assignment is resolved.  The last four options select
+        parts of the results, as for to_dict.  The first line has the
+        categories and likelihood of each assignment:
+
+            {"assignments": [{"categories": ..., "likelihood": ...}, ...]}
+
+        followed, for each resolved assignment (and the first max_resolved
+        ones, which are resolved in turn), by the interpretations of each
+        column in chunks of chunk_size:
+
+            {"assignment": i, "column": j, "start": k, "interpretations": [...]}
+
+        If cat_node_text is given (e.g. GeoWhiz.cat_node_text), each
+        assignment's interpretations are followed by the text of the category
+        nodes that were not already sent:
+
+            {"assignment": i, "cat_node_text": {...}}"""
+        if interpretations not in ('all', 'likely'):
+            raise ValueError('interpretations must be "all" or "likely"')
+        selected = self.assignments[:assignments]
+        yield json.dumps({'assignments': [
+            {'categories': a.categories, 'likelihood': a.likelihood}
+            for a in selected]})
+
+        if fields is not None and 'cat' not in fields:
+            cat_node_text = None
+        sent_nodes = set()
+        for i, a in enumerate(selected):
+            if not a.resolved and (max_resolved is not None and
+                                   i >= max_resolved):
+                continue
+            for j, col in enumerate(a.cell_interpretations):
+                col = shape_interpretations(col, interpretations == 'likely')
+                # (an empty column is sent as one empty chunk)
+                for k in xrange(0, max(len(col), 1), chunk_size):
+                    yield json.dumps({
+                        'assignment': i, 'column': j, 'start': k,
+                        'interpretations': shape_interpretations(
+                            col[k:k+chunk_size], fields=fields,
+                            compact=compact)})
+            if cat_node_text is not None:
+                node_text = dict((node, txt) for node, txt
+                                 in cat_node_text([a]).iteritems()
+                                 if node not in sent_nodes)
+                sent_nodes.update(node_text)
+                yield json.dumps({'assignment': i,
+                                  'cat_node_text': node_text})
+
+
+class GeotagSession(object):
+    """Geotags a grid whose rows are added and removed over time.
+
+    The gazetteer lookup, category counts and resolved interpretations are
+    kept between calls to geotag, so that their cost depends on the rows
+    that changed rather than on the size of the grid (see
+    classifier.GridSession).  Rows are lists of cell values, or strings for
+    a single column.  A session is not thread-safe; lock is provided for
+    callers that share one between threads."""
+
+    def __init__(self, geowhiz, resolution_method=None, include_text=False):
+        self.geowhiz = geowhiz
+        self.include_text = include_text
+        self.state = classifier.GridSession(geowhiz.classifier,
+                                            resolution_method)
+        self.lock = threading.Lock()
+
+    @property
+    def rows(self):
+        return self.state.rows
+
+    def add_rows(self, rows, index=None):
+        """Inserts rows before row index (by default, at the end)"""
+        if index is None:
+            index = len(self.state.rows)
+        self.state.insert_rows(index, [as_row(r) for r in rows])
+
+    def remove_rows(self, start, stop=None):
+        """Removes rows start to stop (exclusive; by default, row start)"""
+        self.state.delete_rows(start, start + 1 if stop is None else stop)
+
+    def set_rows(self, rows):
+        """Replaces the rows, only updating those that differ (between the
+        rows shared at the start and at the end)"""
+        old = self.state.rows
+        new = [tuple(as_row(r)) for r in rows]
+        start = 0
+        while start < min(len(old), len(new)) and old[start] == new[start]:
+            start += 1
+        end = 0
+        while (end < min(len(old), len(new)) - start and
+               old[-1 - end] == new[-1 - end]):
+            end += 1
+        self.state.delete_rows(start, len(old) - end)
+        self.state.insert_rows(start, new[start:len(new) - end])
+
+    def geotag(self, max_resolved=None, assignment=None, top=20):
+        """Geotags the current rows, returning results as
+        GeoWhiz.geotag_full"""
+        if assignment is not None:
+            max_resolved = 0
+        results = self.state.geotag_full(max_resolved=max_resolved, top=top)
+        return self.geowhiz._full_results(results, self.include_text,
+                                          assignment)
+
+
+class StreamGeotagResults(object):
+    def __init__(self, assignment, rows, interpretations, chunks):
+        self.assignment = assignment
+        self.rows = rows
+        self.interpretations = interpretations
+        self.chunks = chunks
+
+    def __iter__(self):
+        # (only if the rows can be iterated again; otherwise pass them to
+        # chunks)
+        return self.chunks()
 
 
 class Assignment(object):
-    def __init__(self, categories, likelihood, cell_interpretations,
-                 *args, **kwargs):
+    def __init__(self, categories, likelihood, cell_interpretations=None,
+                 resolve=None, *args, **kwargs):
         self.categories = categories
         self.likelihood = likelihood
-        self.cell_interpretations = cell_interpretations
+        self._cell_interpretations = cell_interpretations
+        self._resolve = resolve
+
+    @property
+    def resolved(self):
+        return self._cell_interpretations is not None
+
+    def resolve(self):
+        if self._cell_interpretations is None and self._resolve is not None:
+            self._cell_interpretations = self._resolve()
+            self._resolve = None
+        return self._cell_interpretations
+
+    @property
+    def cell_interpretations(self):
+        return self.resolve()
+
+    def category_strings(self):
+        return [list(c['category']) for c in self.categories]
+
+    def to_dict(self, likely=False, fields=None, compact=False):
+        # (see shape_interpretations)
+        interpretations = self._cell_interpretations
+        if interpretations is not None and (likely or fields is not None or
+                                            compact):
+            interpretations = [
+                shape_interpretations(col, likely, fields, compact)
+                for col in interpretations]
+        return {'categories': self.categories,
+                'likelihood': self.likelihood,
+                'cell_interpretations': interpretations}
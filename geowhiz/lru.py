@@ -0,0 +1,77 @@
+import collections
+import threading
+
+
+class LRUCache(object):
+    """A thread-safe least-recently-used cache.
+
+    The cache is bounded by number of entries and, optionally, by the total
+    weight of its values as measured by the weigh function (e.g. an estimate
+    of their size in bytes).
+    """
+    def __init__(self, max_entries=10000, max_weight=None, weigh=None):
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.weigh = weigh or (lambda v: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Like get, but does not count as a use of the entry"""
+        with self._lock:
+            entry = self._data.get(key)
+            return default if entry is None else entry[0]
+
+    def put(self, key, value):
+        w = self.weigh(value)
+        with self._lock:
+            if key in self._data:
+                self.weight -= self._data.pop(key)[1]
+            self._data[key] = (value, w)
+            self.weight += w
+            while self._data and (
+                    len(self._data) > self.max_entries or
+                    (self.max_weight is not None and
+                     self.weight > self.max_weight)):
+                _, (_, old_w) = self._data.popitem(last=False)
+                self.weight -= old_w
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'entries': len(self._data),
+                    'max_entries': self.max_entries,
+                    'weight': self.weight,
+                    'max_weight': self.max_weight,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': float(self.hits) / requests if requests else 0.0}
@@ -0,0 +1,189 @@
+"""
+Proximity resolution: choosing one interpretation per cell so that the chosen
+places are close together.
+
+The two most prominent interpretations of each cell are used as "seeds".  For
+each seed, the closest interpretation of every cell is selected, and the
+collection with the smallest mean square distance to its centroid wins.
+Cells may be weighted (e.g., by the number of rows with the same value).
+
+When NumPy is installed, coordinates are converted to unit vectors once and
+each cell's nearest interpretations are found for all seeds at once.
+Otherwise, distances are computed one pair at a time.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RADIUS = 6371  # km
+
+
+def most_proximate(interpretations, weights=None):
+    """Given a list of interpretations for each cell, and optionally a weight
+    for each cell, returns the selected interpretation of each cell (skipping
+    cells with no interpretations)"""
+    if weights is None:
+        weights = [1] * len(interpretations)
+    if numpy is not None:
+        return _most_proximate_numpy(interpretations, weights)
+    return _most_proximate_python(interpretations, weights)
+
+
+def unit_vectors(lat, lng):
+    phi = (90 - lat) * math.pi / 180
+    theta = lng * math.pi / 180
+    sin_phi = numpy.sin(phi)
+    return numpy.column_stack((sin_phi * numpy.cos(theta),
+                               sin_phi * numpy.sin(theta),
+                               numpy.cos(phi)))
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great circle distances (km) between arrays of points, in degrees"""
+    lat1 = lat1 * math.pi / 180
+    lat2 = lat2 * math.pi / 180
+    dlat = lat2 - lat1
+    dlng = lng2 * math.pi / 180 - lng1 * math.pi / 180
+    a = (numpy.sin(dlat / 2) ** 2 +
+         numpy.sin(dlng / 2) ** 2 * numpy.cos(lat1) * numpy.cos(lat2))
+    return RADIUS * 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+
+def _most_proximate_numpy(interpretations, weights):
+    cells = [interp_list for interp_list in interpretations if interp_list]
+    if not cells:
+        return []
+    cell_weights = [w for interp_list, w in zip(interpretations, weights)
+                    if interp_list]
+    coords = [(numpy.array([i['latitude'] for i in interp_list], dtype=float),
+               numpy.array([i['longitude'] for i in interp_list], dtype=float))
+              for interp_list in cells]
+    vectors = [unit_vectors(lat, lng) for lat, lng in coords]
+    seeds = numpy.concatenate([v[:2] for v in vectors])
+
+    # index of the closest interpretation of each cell, for each seed.
+    # (squared chord length orders the same as great circle distance, and
+    # argmin keeps the first of equally close interpretations)
+    closest = numpy.empty((len(cells), len(seeds)), dtype=int)
+    sums = numpy.zeros((len(seeds), 3))
+    for j, v in enumerate(vectors):
+        diff = seeds[:, numpy.newaxis, :] - v[numpy.newaxis, :, :]
+        closest[j] = (diff * diff).sum(axis=2).argmin(axis=1)
+        sums += cell_weights[j] * v[closest[j]]
+
+    # centroid of each seed's collection, computed as in the pure-Python
+    # version so that equally compact collections compare the same way
+    n = sum(cell_weights)
+    r = numpy.sqrt((sums * sums).sum(axis=1)) / n
+    phi_c = numpy.arccos(numpy.clip(sums[:, 2] / (n * r), -1, 1))
+    theta_c = numpy.arctan2(sums[:, 1], sums[:, 0])
+    lat_c = 90 - 180 * (phi_c / math.pi)
+    lng_c = 180 * theta_c / math.pi
+
+    sq_dists = numpy.zeros(len(seeds))
+    for j, (lat, lng) in enumerate(coords):
+        sq_dists += cell_weights[j] * haversine(
+            lat_c, lng_c, lat[closest[j]], lng[closest[j]]) ** 2
+    best = int((sq_dists / n).argmin())
+
+    return [interp_list[closest[j, best]]
+            for j, interp_list in enumerate(cells)]
+
+
+def _most_proximate_python(interpretations, weights):
+    toRadians = lambda x: x * math.pi / 180
+
+    cache_pt = {}
+    cache_dist = {}
+    def geo_dist(pt1, pt2):
+        if (pt1, pt2) in cache_dist:
+            return cache_dist[(pt1, pt2)]
+        if pt1 in cache_pt:
+            lat1, lng1, lat1cos = cache_pt[pt1]
+        else:
+            lat1 = toRadians(pt1[0])
+            lng1 = toRadians(pt1[1])
+            lat1cos = math.cos(lat1)
+            cache_pt[pt1] = (lat1, lng1, lat1cos)
+        lat2 = toRadians(pt2[0])
+        lng2 = toRadians(pt2[1])
+        lat2cos = math.cos(lat2)
+
+        dlat = lat2 - lat1
+        dlng = lng2 - lng1
+
+        a = math.sin(dlat/2) ** 2 + math.sin(dlng/2) ** 2 * lat1cos * lat2cos
+        res = RADIUS * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+        cache_dist[(pt1, pt2)] = res
+        return res
+
+    cache_coord = {}
+    def geo_coord(lat, lng):
+        if (lat, lng) in cache_coord:
+            return cache_coord[(lat, lng)]
+        phi = (90 - lat) * math.pi / 180
+        theta = (lng) * math.pi / 180
+        x = math.sin(phi) * math.cos(theta)
+        y = math.sin(phi) * math.sin(theta)
+        z = math.cos(phi)
+        cache_coord[(lat, lng)] = (x, y, z)
+        return x, y, z
+
+    def geo_centroid(lat_lng_list, weight_list):
+        xs = []
+        ys = []
+        zs = []
+        for (lat, lng), w in zip(lat_lng_list, weight_list):
+            x, y, z = geo_coord(lat, lng)
+            xs.append(w * x)
+            ys.append(w * y)
+            zs.append(w * z)
+        x_c = sum(xs)
+        y_c = sum(ys)
+        z_c = sum(zs)
+        l = sum(weight_list)
+        r = math.sqrt(x_c**2 + y_c**2 + z_c**2) / l
+        phi_c = math.acos(z_c / (l * r))
+        theta_c = math.atan2(y_c, x_c)
+        lat_c = 90 - 180 * (phi_c / math.pi)
+        lng_c = 180 * theta_c / math.pi
+        return (lat_c, lng_c)
+
+    def geo_mean_sq_dist(interp_list, weight_list):
+        coord_list = [(i['latitude'], i['longitude']) for i in interp_list]
+
+        c = geo_centroid(coord_list, weight_list)
+        sq_dists = [w * geo_dist(c, pt) ** 2
+                    for pt, w in zip(coord_list, weight_list)]
+        return (sum(sq_dists) / sum(weight_list))
+
+    seeds = []
+    for wi in interpretations:
+        seeds.extend(wi[:2])
+
+    best = []
+    best_dist = float('inf')
+    for s in seeds:
+        interp_set = []
+        set_weights = []
+        for interp_list, w in zip(interpretations, weights):
+            best_interp = None
+            best_interp_dist = float('inf')
+            for i in interp_list:
+                i_dist = geo_dist((s['latitude'], s['longitude']),
+                                  (i['latitude'], i['longitude']))
+                if i_dist < best_interp_dist:
+                    best_interp = i
+                    best_interp_dist = i_dist
+            if best_interp:
+                interp_set.append(best_interp)
+                set_weights.append(w)
+        mean_sq_dist = geo_mean_sq_dist(interp_set, set_weights)
+        if mean_sq_dist < best_dist:
+            best = interp_set
+            best_dist = mean_sq_dist
+
+    return best
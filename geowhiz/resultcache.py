@@ -0,0 +1,183 @@
+"""
+Cache of serialized geotag_full results, for lists that are geotagged again
+and again (e.g., lists of states or capitals).
+
+Results are keyed by a hash of the normalized grid, the geotag_full and
+response options, and the model fingerprint of the GeoWhiz instance (which
+identifies the gazetteer too), so a result is never served for a different
+model or gazetteer.  The key doubles as the ETag of the response, when the
+model has a fingerprint (without one, it may be stale after a restart).  Recent
+results are kept in memory and, if a filename is given, written to a SQLite
+database so that they survive restarts.  The database holds the max_stored
+most recently stored results of the current model; results of other models
+are deleted when it is opened.  Each process opens its own connection, when
+it first needs one, so the cache can be created before a server forks its
+workers.  Database errors (e.g. when it is locked by another process for
+longer than timeout seconds) are treated as cache misses.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+from lru import LRUCache
+
+# changed whenever the format of cached results does
+CACHE_VERSION = 1
+
+RESULTS_COLUMNS = ['key', 'version', 'body']
+
+CREATE_RESULTS = """
+CREATE TABLE IF NOT EXISTS results (key text primary key, version text,
+                                    body text)
+""".strip()
+
+DELETE_OTHER_VERSIONS = """
+DELETE FROM results WHERE version != ?
+""".strip()
+
+GET_RESULT = """
+SELECT body FROM results WHERE key = ?
+""".strip()
+
+PUT_RESULT = """
+INSERT OR REPLACE INTO results VALUES (?, ?, ?)
+""".strip()
+
+# rowids increase with each insert, so this deletes all but the newest rows
+DELETE_OLDEST = """
+DELETE FROM results WHERE rowid <= ?
+""".strip()
+
+
+def normalize_grid(grid):
+    """Returns the grid as a list of columns of stripped strings"""
+    if grid and isinstance(grid[0], basestring):
+        grid = [grid]
+    return [[(v or u'').strip() for v in col] for col in grid]
+
+
+class ResultCache(object):
+    """Caches the JSON results (FullGeotagResults.toJSON) of
+    geowhiz.geotag_full.  Thread-safe."""
+
+    def __init__(self, geowhiz, max_entries=10000,
+                 max_bytes=64 * 1024 * 1024, filename=None,
+                 max_stored=100000, timeout=1.0):
+        self.geowhiz = geowhiz
+        self.memory = LRUCache(max_entries, max_bytes, weigh=len)
+        self.max_stored = max_stored
+        self.timeout = timeout
+        self.stored_hits = 0
+        self.store_errors = 0
+        self._lock = threading.Lock()
+
+        # identifies the model and gazetteer, or None if they cannot be
+        # identified across restarts
+        self.fingerprint = geowhiz.model_fingerprint()
+        self._version = json.dumps([CACHE_VERSION, self.fingerprint],
+                                   sort_keys=True)
+        self.filename = filename
+        if filename and self.fingerprint is None:
+            # the gazetteer may change before the next restart
+            print >> sys.stderr, (
+                'Gazetteer has no fingerprint; not storing results in %s' %
+                (filename,))
+            self.filename = None
+        # connection of the process with id _pid (see _connection)
+        self._conn = None
+        self._pid = None
+
+    def key(self, grid, shape=None, **options):
+        """The cache key (and ETag) of geotag_full(grid, **options), as
+        serialized by toJSON(**shape)"""
+        h = hashlib.sha1(self._version)
+        h.update(json.dumps([normalize_grid(grid), options, shape or {}],
+                            sort_keys=True))
+        return h.hexdigest()
+
+    def _connection(self):
+        # returns the database connection of this process, opening it (and
+        # dropping any inherited from a parent process) if needed.  must be
+        # called with _lock held.
+        if self._pid != os.getpid():
+            self._conn = None
+            conn = sqlite3.connect(self.filename, timeout=self.timeout,
+                                   check_same_thread=False)
+            columns = [r[1] for r in
+                       conn.execute('PRAGMA table_info(results)')]
+            if columns and columns != RESULTS_COLUMNS:
+                # written by an earlier version
+                conn.execute('DROP TABLE results')
+            conn.execute(CREATE_RESULTS)
+            conn.execute(DELETE_OTHER_VERSIONS, (self._version,))
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _store(self, f):
+        # runs f(connection) on the database, if there is one, returning None
+        # if there is not or if the database cannot be used
+        if not self.filename:
+            return None
+        with self._lock:
+            try:
+                return f(self._connection())
+            except sqlite3.Error as e:
+                self.store_errors += 1
+                print >> sys.stderr, 'Cannot use %s: %s' % (self.filename, e)
+                if self._conn is not None:
+                    self._conn.rollback()
+                return None
+
+    def get(self, key):
+        body = self.memory.get(key)
+        if body is None:
+            row = self._store(
+                lambda conn: conn.execute(GET_RESULT, (key,)).fetchone())
+            if row is not None:
+                body = str(row[0])
+                self.memory.put(key, body)
+                self.stored_hits += 1
+        return body
+
+    def put(self, key, body):
+        self.memory.put(key, body)
+        self._store(lambda conn: self._put_stored(conn, key, body))
+
+    def _put_stored(self, conn, key, body):
+        rowid = conn.execute(PUT_RESULT, (key, self._version, body)).lastrowid
+        conn.execute(DELETE_OLDEST, (rowid - self.max_stored,))
+        conn.commit()
+
+    def geotag_full(self, grid, shape=None, **options):
+        """Returns (key, JSON results) of geowhiz.geotag_full(grid,
+        **options), serialized by toJSON(**shape), geotagging the grid only
+        if the results are not cached"""
+        grid = normalize_grid(grid)
+        key = self.key(grid, shape, **options)
+        body = self.get(key)
+        if body is None:
+            body = self.geowhiz.geotag_full(grid, **options).toJSON(
+                **(shape or {}))
+            self.put(key, body)
+        return key, body
+
+    def clear(self):
+        self.memory.clear()
+        self._store(self._clear_stored)
+
+    def _clear_stored(self, conn):
+        conn.execute('DELETE FROM results')
+        conn.commit()
+
+    def cache_stats(self):
+        """Hit/miss/eviction counts of the in-memory cache, the number of
+        results read from the database, and the number of failed database
+        reads and writes"""
+        stats = self.memory.stats()
+        stats['stored_hits'] = self.stored_hits
+        stats['store_errors'] = self.store_errors
+        return stats
@@ -1,10 +1,23 @@
 import itertools
-from flask import Flask, request, send_file
+import json
+from flask import Flask, Response, request, send_file, stream_with_context
 
+from lru import LRUCache
+from resultcache import ResultCache
 
-def create_app(geowhiz):
+
+def create_app(geowhiz, max_sessions=1000, result_cache=None):
     app = Flask(__name__)
 
+    # geotag sessions of clients that pass a session id, so that edits to a
+    # list are geotagged incrementally
+    sessions = LRUCache(max_sessions)
+
+    # results of GET requests without a session (in memory only, unless a
+    # ResultCache with a filename is given)
+    if result_cache is None:
+        result_cache = ResultCache(geowhiz)
+
     @app.route('/')
     def index():
         return send_file('index.html')
@@ -30,12 +43,154 @@ def create_app(geowhiz):
 
         grid = list(itertools.izip_longest(*rows))
 
+        # the interpretations of every assignment are included by default;
+        # with max_resolved=1, only the top assignment's are, and the others
+        # can be fetched one at a time by passing their categories (as a JSON
+        # list of category lists) in the assignment parameter
+        max_resolved = request.args.get('max_resolved', type=int)
+        assignment = request.args.get('assignment')
+        if assignment is not None:
+            try:
+                assignment = json.loads(assignment)
+            except ValueError:
+                return bad_request('assignment must be JSON')
+            error = check_assignment(assignment)
+            if error:
+                return bad_request(error)
+
+        # parts of the results to send (see FullGeotagResults.to_dict), e.g.
+        # assignments=1&interpretations=likely&fields=name,latitude,longitude
+        shape = {'assignments': request.args.get('assignments', type=int),
+                 'interpretations': request.args.get('interpretations', 'all'),
+                 'fields': request.args.get('fields'),
+                 'compact': request.args.get('compact') in ('1', 'true')}
+        if shape['fields'] is not None:
+            shape['fields'] = shape['fields'].split(',')
+        error = check_shape(shape)
+        if error:
+            return bad_request(error)
+        top = 20
+        if shape['assignments'] is not None:
+            if max_resolved is None or max_resolved > shape['assignments']:
+                max_resolved = shape['assignments']
+            if assignment is None:
+                top = shape['assignments']
+
+        session_id = request.args.get('session')
+        if session_id is None:
+            options = {'resolution_method': 'both',
+                       'include_text': True,
+                       'max_resolved': max_resolved,
+                       'assignment': assignment,
+                       'top': top}
+            # the cache key identifies the response, so it is the ETag, unless
+            # the model cannot be told apart from the next one (after a
+            # rebuild and restart)
+            use_etag = result_cache.fingerprint is not None
+            etag = result_cache.key(grid, shape, **options)
+            if use_etag and etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                etag, body = result_cache.geotag_full(grid, shape, **options)
+                response = Response(body, mimetype='application/json')
+            if use_etag:
+                response.set_etag(etag)
+            return response
+
+        session = sessions.get(session_id)
+        if session is None:
+            session = geowhiz.session(resolution_method='both',
+                                      include_text=True)
+            sessions.put(session_id, session)
+        with session.lock:
+            session.set_rows(rows)
+            geotag_results = session.geotag(max_resolved=max_resolved,
+                                            assignment=assignment, top=top)
+            return geotag_results.toJSON(**shape)
+
+    @app.route('/geotag', methods=['POST'])
+    def geotag_post():
+        # the request body is a JSON object with the grid to geotag (a list
+        # of columns, each a list of cell values, or a single list of values)
+        # and optionally max_resolved, assignment, resolution_method and the
+        # shaping options of the GET endpoint (fields as a list).  the results
+        # are streamed as newline-delimited JSON (see
+        # FullGeotagResults.iter_ndjson), starting as soon as the categories
+        # are known.
+        body = request.get_json(force=True, silent=True)
+        if not isinstance(body, dict):
+            return bad_request('expected a JSON object')
+
+        grid = body.get('grid')
+        if grid and all(isinstance(v, basestring) for v in grid):
+            grid = [grid]
+        if not grid or not all(
+                isinstance(col, list) and
+                all(isinstance(v, basestring) for v in col)
+                for col in grid):
+            return bad_request('grid must be a list of columns of strings')
+        grid = [[v.strip() for v in col] for col in grid]
+
+        resolution_method = body.get('resolution_method', 'both')
+        if resolution_method not in ('prominence', 'proximity', 'both'):
+            return bad_request('unknown resolution_method')
+        max_resolved = body.get('max_resolved', 1)
+        if max_resolved is not None and not isinstance(max_resolved, int):
+            return bad_request('max_resolved must be an integer or null')
+
+        shape = {'assignments': body.get('assignments'),
+                 'interpretations': body.get('interpretations', 'all'),
+                 'fields': body.get('fields'),
+                 'compact': bool(body.get('compact'))}
+        error = check_shape(shape)
+        if error:
+            return bad_request(error)
+        assignment = body.get('assignment')
+        if assignment is not None:
+            error = check_assignment(assignment)
+            if error:
+                return bad_request(error)
+        top = 20
+        if shape['assignments'] is not None and assignment is None:
+            top = shape['assignments']
+
         geotag_results = geowhiz.geotag_full(
             grid,
-            resolution_method='both',
-            include_text=True
+            resolution_method=resolution_method,
+            include_text=True,
+            max_resolved=0,
+            assignment=assignment,
+            top=top
         )
+        lines = geotag_results.iter_ndjson(
+            max_resolved=max_resolved, cat_node_text=geowhiz.cat_node_text,
+            **shape)
+        return Response(stream_with_context(l + '\n' for l in lines),
+                        mimetype='application/x-ndjson')
+
+    def bad_request(message):
+        return Response(message + '\n', status=400, mimetype='text/plain')
+
+    def check_shape(shape):
+        # returns an error message for invalid shaping options
+        if shape['assignments'] is not None and (
+                not isinstance(shape['assignments'], int) or
+                shape['assignments'] < 0):
+            return 'assignments must be a non-negative integer'
+        if shape['interpretations'] not in ('all', 'likely'):
+            return 'interpretations must be "all" or "likely"'
+        if shape['fields'] is not None and not (
+                isinstance(shape['fields'], list) and
+                all(isinstance(f, basestring) for f in shape['fields'])):
+            return 'fields must be a list of strings'
 
-        return geotag_results.toJSON()
+    def check_assignment(assignment):
+        # returns an error message for an assignment that is not a list of
+        # category lists
+        if not (isinstance(assignment, list) and all(
+                isinstance(cat, list) and
+                all(isinstance(s, basestring) for s in cat)
+                for cat in assignment)):
+            return 'assignment must be a list of lists of strings'
 
     return app
@@ -1,9 +1,11 @@
 import os
 import sqlite3
 import sys
+import uuid
 
 DATAFILE_DIR = sys.argv[1]
 TARGET_DB_FILE = './gaz.db'
+TARGET_SNAPSHOT_FILE = './gaz.snapshot'
 
 conn = sqlite3.connect(TARGET_DB_FILE)
 
@@ -38,6 +40,165 @@ def table(filename, tablename, tablecols, rowdata_func=default_rowdata_func,
 
         conn.commit()
 
+def derived_table(tablename, tablecols, select_sql, indexes=[]):
+    print 'creating derived table'
+    print 'tablename: ', tablename
+    print 'tablecols: ', tablecols
+    drop_table_sql = 'drop table if exists %s' % (tablename,)
+    create_table_sql = 'create table %s %s' % (tablename, tablecols)
+    insert_sql = 'insert into %s %s' % (tablename, select_sql)
+    cur = conn.cursor()
+    cur.execute(drop_table_sql)
+    cur.execute(create_table_sql)
+    cur.execute(insert_sql)
+
+    print 'done inserting into %s' % (tablename,)
+
+    for n, c in indexes:
+        cur.execute('create index %s on %s (%s)' % (n, tablename, c))
+
+    print 'done creating indexes on %s' % (tablename,)
+
+    conn.commit()
+
+CATEGORY_INPUT_SELECT = """
+SELECT g.geonameid, g.fclass, g.fcode, g.country, g.admin1, g.admin2,
+       g.admin3, g.admin4, g.population, c.continent
+  FROM geoname g
+  LEFT JOIN country c ON (g.country = c.iso2)
+"""
+
+def geoname_categories():
+    """Stores the taxonomy category strings of every geoname, so that
+    lookups do not need to run the dimension classifiers at request time"""
+    from geowhiz import category
+    from geowhiz.geowhiz import build_taxonomy, TAXONOMY_VERSION
+
+    print 'creating table'
+    print 'tablename: ', 'geoname_category'
+    taxonomy = build_taxonomy()
+    cur = conn.cursor()
+    cur.execute('drop table if exists geoname_category')
+    cur.execute('create table geoname_category (geonameid integer primary ' +
+                'key, cat_type text, cat_geo text, cat_prom text)')
+
+    read_cur = conn.cursor()
+    read_cur.row_factory = sqlite3.Row
+    read_cur.execute(CATEGORY_INPUT_SELECT)
+    rowdata = ([r['geonameid']] +
+               category.l_to_s(taxonomy.categorize(dict(r)))
+               for r in read_cur)
+    cur.executemany('insert or replace into geoname_category values ' +
+                    '(?, ?, ?, ?)', rowdata)
+
+    print 'done inserting into geoname_category'
+
+    cur.execute('create table if not exists meta ' +
+                '(key text primary key, value text)')
+    cur.execute('insert or replace into meta values (?, ?)',
+                ('taxonomy_version', str(TAXONOMY_VERSION)))
+    conn.commit()
+
+# one row per (lookup name, geoname), deduplicated and sorted at build time so
+# that the gazetteer can answer each string with a single primary key probe
+NAME_LOOKUP_COLS = (
+    '(name text, geonameid integer, official_name text, altnames integer, ' +
+    'latitude real, longitude real, fclass text, fcode text, country text, ' +
+    'cc2 text, admin1 text, admin2 text, admin3 text, admin4 text, ' +
+    'elevation integer, population integer, continent text, ' +
+    'cat_type text, cat_geo text, cat_prom text, ' +
+    'primary key (name, geonameid)) without rowid'
+)
+
+NAME_LOOKUP_SELECT = """
+SELECT u.name, g.geonameid, g.name, length(g.altnames) -
+       length(replace(g.altnames, ',', '')), g.latitude, g.longitude,
+       g.fclass, g.fcode, g.country, g.cc2, g.admin1, g.admin2, g.admin3,
+       g.admin4, g.elevation, g.population, c.continent, gc.cat_type,
+       gc.cat_geo, gc.cat_prom
+  FROM (SELECT name, geonameid FROM geoname
+        UNION
+        SELECT asciiname, geonameid FROM geoname
+        UNION
+        SELECT altname, geonameid FROM altname) u
+  JOIN geoname g ON (u.geonameid = g.geonameid)
+  LEFT JOIN country c ON (g.country = c.iso2)
+  LEFT JOIN geoname_category gc ON (g.geonameid = gc.geonameid)
+ WHERE u.name IS NOT NULL
+ ORDER BY u.name, g.geonameid
+"""
+
+# names with fewer interpretations than this are cheap to categorize at
+# runtime, so no histogram is stored for them
+HISTOGRAM_MIN_INTERPRETATIONS = 8
+
+HISTOGRAM_INPUT_SELECT = """
+SELECT name, fclass, fcode, country, admin1, admin2, admin3, admin4,
+       population, continent
+  FROM name_lookup
+ WHERE name IN (SELECT name FROM name_lookup
+                 GROUP BY name HAVING count(*) >= ?)
+ ORDER BY name, geonameid
+"""
+
+def name_histograms():
+    """Stores, for each name with many interpretations, the number of its
+    interpretations that satisfy each category (see category.histogram)"""
+    import itertools
+    from geowhiz import category
+    from geowhiz.geowhiz import build_taxonomy
+
+    print 'creating table'
+    print 'tablename: ', 'name_histogram'
+    taxonomy = build_taxonomy()
+    cur = conn.cursor()
+    cur.execute('drop table if exists name_histogram')
+    cur.execute('create table name_histogram (name text primary key, ' +
+                'histogram blob) without rowid')
+
+    read_cur = conn.cursor()
+    read_cur.row_factory = sqlite3.Row
+    read_cur.execute(HISTOGRAM_INPUT_SELECT, (HISTOGRAM_MIN_INTERPRETATIONS,))
+    rowdata = (
+        (name, sqlite3.Binary(category.encode_histogram(category.histogram(
+            taxonomy.categorize(dict(r)) for r in rows))))
+        for name, rows in itertools.groupby(read_cur, lambda r: r['name'])
+    )
+    cur.executemany('insert into name_histogram values (?, ?)', rowdata)
+
+    print 'done inserting into name_histogram'
+
+    conn.commit()
+
+def type_text():
+    """Stores the finished text of each type category (see
+    cattext.build_type_text), so that it is not built at runtime"""
+    from geowhiz import cattext
+
+    print 'creating table'
+    print 'tablename: ', 'type_text'
+    cur = conn.cursor()
+    cur.execute('select fclass, fcode, name, description from featurecodes')
+    types = cattext.build_type_text(cur.fetchall())
+    cur.execute('drop table if exists type_text')
+    cur.execute('create table type_text (code text primary key, type text, ' +
+                'plural text, description text) without rowid')
+    cur.executemany('insert into type_text values (?, ?, ?, ?)',
+                    ((code, t['type'], t['plural'], t['desc'])
+                     for code, t in types.iteritems()))
+
+    print 'done inserting into type_text'
+
+    conn.commit()
+
+def record_build_id():
+    """Tags the build with a unique id, used as the gazetteer fingerprint
+    (e.g. to tell whether a saved classifier model is stale)"""
+    cur = conn.cursor()
+    cur.execute('insert or replace into meta values (?, ?)',
+                ('build_id', uuid.uuid4().hex))
+    conn.commit()
+
 if __name__ == '__main__':
 
     table(
@@ -118,6 +279,20 @@ if __name__ == '__main__':
         indexes=[('country_lookup', 'iso2')]
     )
 
+    geoname_categories()
+
+    derived_table('name_lookup', NAME_LOOKUP_COLS, NAME_LOOKUP_SELECT)
+
+    name_histograms()
+
+    type_text()
+
+    record_build_id()
+
+    from geowhiz.gaz.snapshot import write_snapshot
+    print 'writing snapshot: ', TARGET_SNAPSHOT_FILE
+    write_snapshot(conn, TARGET_SNAPSHOT_FILE)
+
     # TODO: no instr in sqlite 3.6 (on sametsrv01), so need workaround
     add_counties = """
     insert into altname
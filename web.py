@@ -1,11 +1,13 @@
 import geowhiz
+from geowhiz.gaz.cache import cachedGaz
 from geowhiz.gaz.sqlite import sqliteGaz
+from geowhiz.resultcache import ResultCache
 
-gaz = sqliteGaz('./gaz.db', recreate_conn=True)
+gaz = cachedGaz(sqliteGaz('./gaz.db', pool_size=8), max_bytes=256 * 1024 * 1024)
 
-g = geowhiz.GeoWhiz(gaz=gaz)
-application = g.web_app()
+g = geowhiz.GeoWhiz(gaz=gaz, model_file='./geowhiz.model')
+application = g.web_app(result_cache=ResultCache(g, filename='./results.db'))
 
 if __name__ == '__main__':
     application.debug = True
-    application.run(host='0.0.0.0')
+    application.run(host='0.0.0.0', threaded=True)